@@ -0,0 +1,377 @@
+"""Load test for the PicoChat backend.
+
+Starts the app in-process with uvicorn, seeds users, conversations and
+message history, then measures chat-list loads, history fetches, REST
+sends and websocket send/fan-out. Results are written as JSON so runs can
+be compared across versions.
+
+    python bench.py --users 200 --conversations 400 --history 500
+    python bench.py --in-memory --output bench-results.json
+
+Needs the packages in requirements-bench.txt. Without --in-memory it uses
+MONGO_URL and drops the benchmark database (its name must contain
+"bench") before seeding. mongomock is far slower than mongod, so
+--in-memory starts from the smaller IN_MEMORY_SIZES (about a minute);
+any size flag passed explicitly still wins.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "picochat_bench")
+# The bench drives a handful of users far past what per-user limits allow
+os.environ.setdefault("WS_CONNECTION_FRAME_RATE", "100000/100000")
+os.environ.setdefault("WS_USER_FRAME_RATES", "message=100000/100000,sync=100000/100000")
+
+import httpx
+import msgpack
+import uvicorn
+import websockets
+
+import server
+
+# Workload sizes for a real mongod, and the smaller set used with --in-memory
+DEFAULT_SIZES = {
+    "users": 100, "conversations": 200, "history": 200, "requests": 1000,
+    "ws_conversations": 50, "ws_messages": 20,
+}
+IN_MEMORY_SIZES = {
+    "users": 20, "conversations": 40, "history": 50, "requests": 200,
+    "ws_conversations": 10, "ws_messages": 10,
+}
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def summarize(name, latencies, elapsed, errors=0):
+    ms = [x * 1000 for x in latencies]
+    return {
+        "scenario": name,
+        "operations": len(latencies),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_s": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(ms, 50), 2) if ms else None,
+        "p95_ms": round(percentile(ms, 95), 2) if ms else None,
+        "p99_ms": round(percentile(ms, 99), 2) if ms else None,
+        "mean_ms": round(statistics.fmean(ms), 2) if ms else None,
+    }
+
+async def run_concurrently(count, concurrency, operation):
+    # Runs operation(i) count times with at most `concurrency` in flight
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await operation(i)
+            except Exception:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    return latencies, time.perf_counter() - started, errors
+
+async def seed(db, args):
+    # Written straight to Mongo: going through the API would spend the run on bcrypt
+    password = server.pwd_context.hash("bench-password")
+    now = datetime.now(timezone.utc)
+    users = []
+    for i in range(args.users):
+        users.append({
+            "id": str(uuid.uuid4()),
+            "username": f"bench_user_{i}",
+            "password": password,
+            "display_name": f"Bench User {i}",
+            "avatar": None,
+            "is_online": False,
+            "last_seen": now.isoformat(),
+            "created_at": now.isoformat(),
+            **server.directory_fields(f"bench_user_{i}", f"Bench User {i}"),
+        })
+    await db.users.insert_many(users)
+
+    rng = random.Random(args.seed)
+    pairs = set()
+    while len(pairs) < min(args.conversations, args.users * (args.users - 1) // 2):
+        a, b = rng.sample(range(args.users), 2)
+        pairs.add((min(a, b), max(a, b)))
+
+    conversations = []
+    for a, b in pairs:
+        ua, ub = users[a], users[b]
+        conv = {
+            "id": str(uuid.uuid4()),
+            "participants": [ua["id"], ub["id"]],
+            "participant_snapshots": {
+                ua["id"]: server.user_snapshot(ua),
+                ub["id"]: server.user_snapshot(ub),
+            },
+            "last_message_id": None,
+            "last_message": None,
+            "last_activity": now.isoformat(),
+            "unread_count": {ua["id"]: 0, ub["id"]: 0},
+            "seq": 0,
+            "created_at": now.isoformat(),
+        }
+        messages = []
+        started = now - timedelta(seconds=args.history)
+        for j in range(args.history):
+            sender = rng.choice((ua, ub))
+            messages.append({
+                "id": str(uuid.uuid4()),
+                "conversation_id": conv["id"],
+                "sender_id": sender["id"],
+                "sender_name": sender["display_name"],
+                "content": f"history message {j}",
+                "type": "text",
+                "file_url": None,
+                "reply_to": None,
+                "timestamp": (started + timedelta(seconds=j)).isoformat(),
+                "status": "sent",
+                "seq": j + 1,
+            })
+        if messages:
+            await db.messages.insert_many(messages)
+            last = {k: v for k, v in messages[-1].items() if k != "_id"}
+            conv.update(
+                last_message_id=last["id"], last_message=last, last_activity=last["timestamp"], seq=len(messages)
+            )
+        conversations.append(conv)
+    await db.conversations.insert_many(conversations)
+
+    tokens = {u["id"]: server.create_access_token({"sub": u["id"]}) for u in users}
+    return users, conversations, tokens
+
+def auth(tokens, user_id):
+    return {"Authorization": f"Bearer {tokens[user_id]}"}
+
+async def bench_chat_list(http, users, tokens, args):
+    rng = random.Random(args.seed + 1)
+
+    async def op(_):
+        user = rng.choice(users)
+        response = await http.get("/api/conversations", headers=auth(tokens, user["id"]))
+        response.raise_for_status()
+
+    return summarize("chat_list", *await run_concurrently(args.requests, args.concurrency, op))
+
+async def bench_history(http, conversations, tokens, args):
+    rng = random.Random(args.seed + 2)
+
+    async def op(_):
+        conv = rng.choice(conversations)
+        headers = auth(tokens, conv["participants"][0])
+        response = await http.get(f"/api/messages/{conv['id']}", params={"limit": 50}, headers=headers)
+        response.raise_for_status()
+        cursor = response.json()["next_cursor"]
+        if cursor:
+            older = await http.get(
+                f"/api/messages/{conv['id']}", params={"limit": 50, "before": cursor}, headers=headers
+            )
+            older.raise_for_status()
+
+    return summarize("history_fetch", *await run_concurrently(args.requests, args.concurrency, op))
+
+async def bench_rest_send(http, conversations, tokens, args):
+    rng = random.Random(args.seed + 3)
+
+    async def op(i):
+        conv = rng.choice(conversations)
+        response = await http.post(
+            f"/api/messages/{conv['id']}",
+            json={"content": f"bench rest message {i}"},
+            headers=auth(tokens, conv["participants"][0]),
+        )
+        response.raise_for_status()
+
+    return summarize("rest_send", *await run_concurrently(args.requests, args.concurrency, op))
+
+async def bench_websocket(base_ws, conversations, tokens, args):
+    # One socket per participant of the sampled conversations; the sender's
+    # echo gives send latency, the peer's copy gives fan-out latency.
+    rng = random.Random(args.seed + 4)
+    sample = rng.sample(conversations, min(args.ws_conversations, len(conversations)))
+    user_ids = {pid for conv in sample for pid in conv["participants"]}
+    binary = args.ws_format == "msgpack"
+    subprotocols = [server.WS_MSGPACK_PROTOCOL] if binary else None
+    sockets = {}
+    for user_id in user_ids:
+        sockets[user_id] = await websockets.connect(
+            f"{base_ws}/ws/{tokens[user_id]}", max_size=None, subprotocols=subprotocols
+        )
+
+    def encode(frame):
+        return msgpack.packb(frame) if binary else json.dumps(frame)
+
+    def decode(raw):
+        # Binary frames carry a batch of events, JSON frames a single one
+        return msgpack.unpackb(raw) if binary else [json.loads(raw)]
+
+    sent_at = {}
+    send_latencies = []
+    fanout_latencies = []
+    # Every message reaches the sender and the other participant
+    expected = len(sample) * args.ws_messages * 2
+    received = 0
+    bytes_received = 0
+    done = asyncio.Event()
+
+    async def reader(user_id, ws):
+        nonlocal received, bytes_received
+        async for raw in ws:
+            bytes_received += len(raw)
+            for data in decode(raw):
+                if data.get("type") != "new_message":
+                    continue
+                marker = data["message"].get("content")
+                if marker not in sent_at:
+                    continue
+                latency = time.perf_counter() - sent_at[marker]
+                if data["message"]["sender_id"] == user_id:
+                    send_latencies.append(latency)
+                else:
+                    fanout_latencies.append(latency)
+                received += 1
+                if received >= expected:
+                    done.set()
+
+    readers = [asyncio.create_task(reader(uid, ws)) for uid, ws in sockets.items()]
+
+    async def sender(conv):
+        user_id = conv["participants"][0]
+        for i in range(args.ws_messages):
+            marker = f"ws-{conv['id']}-{i}"
+            sent_at[marker] = time.perf_counter()
+            await sockets[user_id].send(encode({
+                "type": "message", "conversation_id": conv["id"], "content": marker
+            }))
+            await asyncio.sleep(args.ws_interval)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender(conv) for conv in sample))
+    try:
+        await asyncio.wait_for(done.wait(), timeout=args.ws_timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - started
+
+    for task in readers:
+        task.cancel()
+    for ws in sockets.values():
+        await ws.close()
+
+    sent = len(sample) * args.ws_messages
+    fanout = summarize("ws_fanout", fanout_latencies, elapsed, errors=sent - len(fanout_latencies))
+    # Decompressed payload bytes; permessage-deflate shrinks the wire further
+    fanout["bytes_received"] = bytes_received
+    return [
+        summarize("ws_send", send_latencies, elapsed, errors=sent - len(send_latencies)),
+        fanout,
+    ]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def main(args):
+    if args.in_memory:
+        from mongomock_motor import AsyncMongoMockClient
+        server.client = AsyncMongoMockClient()
+        server.db = server.client[os.environ["DB_NAME"]]
+    else:
+        if "bench" not in os.environ["DB_NAME"]:
+            sys.exit("Refusing to drop a database whose name doesn't contain 'bench'")
+        await server.client.drop_database(os.environ["DB_NAME"])
+
+    port = free_port()
+    config = uvicorn.Config(server.app, host="127.0.0.1", port=port, log_level="warning")
+    uvicorn_server = uvicorn.Server(config)
+    serve_task = asyncio.create_task(uvicorn_server.serve())
+    while not uvicorn_server.started:
+        await asyncio.sleep(0.05)
+
+    started = time.perf_counter()
+    users, conversations, tokens = await seed(server.db, args)
+    seed_seconds = time.perf_counter() - started
+
+    results = []
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60) as http:
+        results.append(await bench_chat_list(http, users, tokens, args))
+        results.append(await bench_history(http, conversations, tokens, args))
+        results.append(await bench_rest_send(http, conversations, tokens, args))
+    results.extend(await bench_websocket(f"ws://127.0.0.1:{port}", conversations, tokens, args))
+
+    uvicorn_server.should_exit = True
+    await serve_task
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "backend": "in-memory" if args.in_memory else "mongod",
+        "parameters": {k: v for k, v in vars(args).items() if k != "output"},
+        "seed_seconds": round(seed_seconds, 2),
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2))
+
+    for row in results:
+        print(f"{row['scenario']:<14} ops={row['operations']:<6} err={row['errors']:<4} "
+              f"thr={row['throughput_per_s']}/s p50={row['p50_ms']}ms p95={row['p95_ms']}ms p99={row['p99_ms']}ms")
+    print(f"Results written to {args.output}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="PicoChat load test")
+    parser.add_argument("--users", type=int)
+    parser.add_argument("--conversations", type=int)
+    parser.add_argument("--history", type=int, help="messages per conversation")
+    parser.add_argument("--requests", type=int, help="requests per REST scenario")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--ws-conversations", type=int)
+    parser.add_argument("--ws-messages", type=int, help="messages per websocket sender")
+    parser.add_argument("--ws-interval", type=float, default=0.01, help="seconds between websocket sends")
+    parser.add_argument("--ws-timeout", type=float, default=30.0)
+    parser.add_argument("--ws-format", choices=("json", "msgpack"), default="json")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--in-memory", action="store_true", help="use mongomock-motor instead of MONGO_URL")
+    parser.add_argument("--output", default="bench-results.json")
+    args = parser.parse_args()
+    sizes = IN_MEMORY_SIZES if args.in_memory else DEFAULT_SIZES
+    for name, value in sizes.items():
+        if getattr(args, name) is None:
+            setattr(args, name, value)
+    return args
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
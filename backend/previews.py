@@ -0,0 +1,78 @@
+# Preview generation for uploaded media. These functions run in a separate
+# process pool (see server.py), so this module stays free of app imports to
+# keep worker start-up cheap.
+import base64
+import io
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+
+try:
+    from PIL import Image, ImageFilter, ImageOps
+except ImportError:  # Pillow is optional; without it no previews are generated
+    Image = None
+
+THUMBNAIL_SIZE = 320
+PLACEHOLDER_SIZE = 16
+FFMPEG = shutil.which("ffmpeg")
+
+
+def available() -> bool:
+    return Image is not None
+
+
+def _render(image, thumb_path: Path) -> dict:
+    image = ImageOps.exif_transpose(image)
+    width, height = image.size
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    thumb = image.copy()
+    thumb.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    thumb_path.parent.mkdir(parents=True, exist_ok=True)
+    thumb.save(thumb_path, "JPEG", quality=80, optimize=True)
+
+    # A few hundred bytes the client can paint while the thumbnail loads
+    tiny = image.copy()
+    tiny.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+    tiny = tiny.filter(ImageFilter.GaussianBlur(1))
+    buffer = io.BytesIO()
+    tiny.save(buffer, "JPEG", quality=50)
+    placeholder = "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+    return {"width": width, "height": height, "placeholder": placeholder}
+
+
+def image_preview(source: str, thumb_path: str) -> dict:
+    with Image.open(source) as image:
+        return _render(image, Path(thumb_path))
+
+
+def video_preview(source: str, thumb_path: str):
+    # Poster frame from the first second, when ffmpeg is installed
+    if not FFMPEG:
+        return None
+    with tempfile.TemporaryDirectory() as tmp:
+        poster = Path(tmp) / "poster.png"
+        for seek in ("1", "0"):
+            result = subprocess.run(
+                [FFMPEG, "-v", "error", "-y", "-ss", seek, "-i", source, "-frames:v", "1", str(poster)],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60
+            )
+            if result.returncode == 0 and poster.exists():
+                break
+        else:
+            return None
+        with Image.open(poster) as image:
+            return _render(image, Path(thumb_path))
+
+
+def generate(kind: str, source: str, thumb_path: str):
+    if Image is None:
+        return None
+    if kind == "image":
+        return image_preview(source, thumb_path)
+    if kind == "video":
+        return video_preview(source, thumb_path)
+    return None
@@ -1,27 +1,205 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, WebSocket, WebSocketDisconnect, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, WebSocket, WebSocketDisconnect, Query, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import PlainTextResponse, RedirectResponse, Response
+from starlette.datastructures import UploadFile as StarletteUploadFile
+from starlette.formparsers import MultiPartException, MultiPartParser
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReplaceOne, ReturnDocument, UpdateMany, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
+from typing import Dict, List, Optional
 import uuid
 from datetime import datetime, timezone, timedelta
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 import json
+import base64
+import hashlib
+import math
+import zlib
+import asyncio
+import socket
+import time
+import bisect
+import re
+import threading
+import mimetypes
+import ipaddress
+from email.utils import parsedate_to_datetime
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
 import aiofiles
+import previews
+
+try:
+    import msgpack
+except ImportError:  # the binary websocket protocol is only offered when installed
+    msgpack = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# ===================== METRICS =====================
+
+# Minimal Prometheus text-format metrics. Updates are a dict lookup and a
+# couple of additions under a lock (Mongo listeners run on driver threads).
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, *labels, value: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+    
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in list(self._values.items()):
+            lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}  # labels -> [per-bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+    
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, series in list(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                bucket_labels = format_labels(self.labelnames + ("le",), labels + (str(bound),))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+class Gauge:
+    # Value is read from a callback at scrape time, so nothing is kept in
+    # sync on the hot path. The callback returns a number or {labels: value}.
+    def __init__(self, name: str, help_text: str, callback, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.callback = callback
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        value = self.callback()
+        if isinstance(value, dict):
+            for labels, v in value.items():
+                lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {v}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+METRICS = []
+
+def register_metric(metric):
+    METRICS.append(metric)
+    return metric
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+http_request_duration = register_metric(Histogram(
+    "picochat_http_request_duration_seconds", "HTTP request latency by route", ("method", "route", "status")
+))
+mongo_command_duration = register_metric(Histogram(
+    "picochat_mongo_command_duration_seconds", "MongoDB command latency", ("collection", "command")
+))
+mongo_command_failures = register_metric(Counter(
+    "picochat_mongo_command_failures_total", "Failed MongoDB commands", ("collection", "command")
+))
+ws_frames_received = register_metric(Counter(
+    "picochat_ws_frames_received_total", "Websocket frames received by type", ("type",)
+))
+ws_events_sent = register_metric(Counter(
+    "picochat_ws_events_sent_total", "Websocket events written to clients by type", ("type",)
+))
+ws_events_dropped = register_metric(Counter(
+    "picochat_ws_events_dropped_total", "Events dropped or coalesced for slow websocket clients"
+))
+event_loop_lag = register_metric(Histogram(
+    "picochat_event_loop_lag_seconds", "Event loop wake-up delay",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+))
+
+# Commands slower than this are logged as warnings
+SLOW_QUERY_MS = int(os.environ.get('SLOW_QUERY_MS', '100'))
+SLOW_QUERY_COMMANDS = ("find", "aggregate", "update", "delete", "count", "distinct", "findAndModify")
+
+class MongoCommandListener(monitoring.CommandListener):
+    # Times every command per collection and logs slow queries
+    def __init__(self):
+        self._commands = {}
+    
+    def started(self, event):
+        collection = event.command.get("collection" if event.command_name == "getMore" else event.command_name)
+        if not isinstance(collection, str):
+            collection = ""
+        command = event.command if event.command_name in SLOW_QUERY_COMMANDS else None
+        self._commands[event.request_id] = (collection, command)
+    
+    def succeeded(self, event):
+        collection, command = self._commands.pop(event.request_id, ("", None))
+        mongo_command_duration.observe(event.duration_micros / 1_000_000, collection, event.command_name)
+        duration_ms = event.duration_micros / 1000
+        if command is not None and duration_ms >= SLOW_QUERY_MS:
+            logging.getLogger("picochat.slow_query").warning(
+                "Slow %s on %s took %.1f ms: %s",
+                event.command_name, collection, duration_ms,
+                {k: v for k, v in command.items() if k in ("filter", "sort", "pipeline", "updates")}
+            )
+    
+    def failed(self, event):
+        collection, _ = self._commands.pop(event.request_id, ("", None))
+        mongo_command_failures.inc(collection, event.command_name)
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandListener()])
 db = client[os.environ['DB_NAME']]
 
 # JWT Settings
@@ -30,7 +208,12 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_DAYS = 30
 
 # Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '2'))
+# Hash/verify calls allowed in flight (running + queued) before login and
+# register start answering 503
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', '32'))
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 
 # Create the main app
 app = FastAPI()
@@ -39,10 +222,31 @@ app = FastAPI()
 UPLOAD_DIR = ROOT_DIR / "uploads"
 UPLOAD_DIR.mkdir(exist_ok=True)
 
+# Partially received resumable uploads
+UPLOAD_PARTIAL_DIR = UPLOAD_DIR / ".partial"
+UPLOAD_PARTIAL_DIR.mkdir(exist_ok=True)
+
+# Content-addressed media, sharded by the first bytes of the sha256
+MEDIA_DIR = UPLOAD_DIR / "media"
+MEDIA_DIR.mkdir(exist_ok=True)
+
+# Upload limits
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', str(1024 * 1024)))
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', str(100 * 1024 * 1024)))
+UPLOAD_SESSION_HOURS = 24
+UPLOAD_CLEANUP_INTERVAL_SECONDS = float(os.environ.get('UPLOAD_CLEANUP_INTERVAL_SECONDS', '3600'))
+
+# Group conversations
+GROUP_MAX_MEMBERS = int(os.environ.get('GROUP_MAX_MEMBERS', '500'))
+# Conversation payloads carry only this many group members; the full list
+# is paged from /api/groups/{id}/members
+GROUP_PREVIEW_MEMBERS = int(os.environ.get('GROUP_PREVIEW_MEMBERS', '20'))
+
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
 # ===================== MODELS =====================
 
@@ -85,13 +289,75 @@ class MessageResponse(BaseModel):
     reply_to: Optional[dict] = None
     timestamp: str
     status: str = "sent"
+    preview: Optional[dict] = None
+    seq: Optional[int] = None
+
+class UploadSessionCreate(BaseModel):
+    filename: str
+    content_type: Optional[str] = None
+    size: int = Field(gt=0)
+    reply_to: Optional[str] = None
+
+class UploadSessionResponse(BaseModel):
+    upload_id: str
+    offset: int
+    size: int
+    chunk_size: int
+
+class MediaTokenRequest(BaseModel):
+    url: str
+
+class MediaTokenResponse(BaseModel):
+    url: str
+    expires_at: str
+
+class MessagePage(BaseModel):
+    messages: List[MessageResponse]
+    next_cursor: Optional[str] = None
+
+class SearchResult(MessageResponse):
+    conversation_id: str
+
+class SearchPage(BaseModel):
+    results: List[SearchResult]
+    next_cursor: Optional[str] = None
+
+class UserPage(BaseModel):
+    users: List[UserResponse]
+    next_cursor: Optional[str] = None
+
+class GroupCreate(BaseModel):
+    name: str = Field(min_length=1, max_length=100)
+    member_ids: List[str] = []
+
+class GroupMembers(BaseModel):
+    member_ids: List[str] = Field(min_length=1)
 
 class ConversationResponse(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str
+    type: str = "direct"  # direct, group
+    name: Optional[str] = None
+    created_by: Optional[str] = None
     participants: List[UserResponse]
+    member_count: int = 0
     last_message: Optional[MessageResponse] = None
     unread_count: int = 0
+    seq: int = 0
+
+class SyncRequest(BaseModel):
+    # Last sequence number the client has seen, per conversation
+    since: Dict[str, int] = {}
+
+class ConversationSync(BaseModel):
+    conversation: ConversationResponse
+    messages: List[MessageResponse]
+    read_upto: Dict[str, str] = {}
+    seq: int
+    has_more: bool = False
+
+class SyncResponse(BaseModel):
+    conversations: List[ConversationSync]
 
 # ===================== AUTH HELPERS =====================
 
@@ -99,11 +365,67 @@ class ConversationResponse(BaseModel):
 async def root():
     return {"message": "پیامرسان خصوصی API"}
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+class PasswordHasher:
+    # bcrypt runs on a small thread pool (it releases the GIL) so a burst of
+    # logins can't block the event loop; past max_pending callers are shed.
+    def __init__(self, workers: int, max_pending: int):
+        self.max_pending = max_pending
+        self.in_flight = 0
+        self.calls = 0
+        self.shed = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+    
+    @staticmethod
+    def _timed(fn, *args):
+        started = time.perf_counter()
+        result = fn(*args)
+        return result, time.perf_counter() - started
+    
+    async def _run(self, fn, *args):
+        if self.in_flight >= self.max_pending:
+            self.shed += 1
+            raise HTTPException(
+                status_code=503,
+                detail="سرور شلوغ است، کمی بعد دوباره تلاش کنید",
+                headers={"Retry-After": "1"}
+            )
+        self.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            result, duration = await loop.run_in_executor(self._executor, self._timed, fn, *args)
+        finally:
+            self.in_flight -= 1
+        # Time that used to be spent blocking the event loop
+        self.calls += 1
+        self.total_seconds += duration
+        self.max_seconds = max(self.max_seconds, duration)
+        return result
+    
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(pwd_context.verify, plain_password, hashed_password)
+    
+    async def hash(self, password: str) -> str:
+        return await self._run(pwd_context.hash, password)
+    
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "in_flight": self.in_flight,
+            "shed": self.shed,
+            "rounds": BCRYPT_ROUNDS,
+            "offloaded_ms_total": round(self.total_seconds * 1000, 1),
+            "offloaded_ms_max": round(self.max_seconds * 1000, 1)
+        }
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING)
 
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await password_hasher.verify(plain_password, hashed_password)
+
+async def get_password_hash(password: str) -> str:
+    return await password_hasher.hash(password)
 
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
@@ -111,20 +433,710 @@ def create_access_token(data: dict) -> str:
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
-    token = credentials.credentials
+# ===================== CACHES =====================
+
+# Small in-process caches for the lookups every request and websocket
+# frame makes. Entries are dropped on local writes and expire after
+# CACHE_TTL_SECONDS, which bounds staleness across workers.
+CACHE_TTL_SECONDS = float(os.environ.get('CACHE_TTL_SECONDS', '30'))
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '10000'))
+CONVERSATION_CACHE_SIZE = int(os.environ.get('CONVERSATION_CACHE_SIZE', '50000'))
+
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+    
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+    
+    def set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+    
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+    
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+user_cache = TTLCache(USER_CACHE_SIZE, CACHE_TTL_SECONDS)
+# Only id and participants are cached; counters and summaries always come from Mongo
+conversation_cache = TTLCache(CONVERSATION_CACHE_SIZE, CACHE_TTL_SECONDS)
+
+async def get_user_cached(user_id: str) -> Optional[dict]:
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await db.users.find_one({"id": user_id}, {"_id": 0})
+        if user is not None:
+            user_cache.set(user_id, user)
+    return user
+
+async def get_conversation_cached(conversation_id: str) -> Optional[dict]:
+    conv = conversation_cache.get(conversation_id)
+    if conv is None:
+        conv = await db.conversations.find_one({"id": conversation_id}, {"_id": 0, "id": 1, "participants": 1})
+        if conv is not None:
+            conversation_cache.set(conversation_id, conv)
+    return conv
+
+async def get_conversation_for_user(conversation_id: str, user_id: str) -> dict:
+    conv = await get_conversation_cached(conversation_id)
+    if not conv or user_id not in conv["participants"]:
+        raise HTTPException(status_code=403, detail="دسترسی ندارید")
+    return conv
+
+async def user_from_token(token: str) -> dict:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id = payload.get("sub")
-        if user_id is None:
+        # Scoped tokens (signed media URLs) are not login tokens
+        if user_id is None or "scope" in payload:
             raise HTTPException(status_code=401, detail="Invalid token")
-        user = await db.users.find_one({"id": user_id}, {"_id": 0})
+        user = await get_user_cached(user_id)
         if user is None:
             raise HTTPException(status_code=401, detail="User not found")
         return user
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+    return await user_from_token(credentials.credentials)
+
+# ===================== RATE LIMITING =====================
+
+# Token buckets, kept per worker: "rate/burst" means `rate` tokens a second
+# refilled up to `burst`. Frames and requests over their limit are refused
+# straight away (error frame or 429) rather than queued. Upload bytes may run
+# into debt so any file size fits; the next upload waits until it is repaid.
+# EXPENSIVE_CONCURRENCY caps how many costly handlers run at once per worker.
+# Uploads, which hold their slot while the client sends, have their own pool
+# (UPLOAD_CONCURRENCY, at most UPLOAD_USER_CONCURRENCY per user), and a body
+# that stops arriving for UPLOAD_READ_TIMEOUT_SECONDS gives its slot up.
+def parse_rate(spec: str) -> tuple:
+    rate, _, burst = spec.partition("/")
+    return float(rate), float(burst or rate)
+
+WS_CONNECTION_FRAME_RATE = parse_rate(os.environ.get('WS_CONNECTION_FRAME_RATE', '20/40'))
+WS_USER_FRAME_RATES = {
+    frame_type: parse_rate(spec)
+    for frame_type, _, spec in (
+        item.partition("=")
+        for item in os.environ.get('WS_USER_FRAME_RATES', 'message=5/20,typing=2/5,read=5/10,sync=0.5/5').split(",")
+        if item
+    )
+}
+UPLOAD_REQUEST_RATE = parse_rate(os.environ.get('UPLOAD_REQUEST_RATE', '1/10'))
+UPLOAD_BYTES_RATE = parse_rate(os.environ.get('UPLOAD_BYTES_RATE', f'{2 * 1024 * 1024}/{50 * 1024 * 1024}'))
+EXPENSIVE_CONCURRENCY = int(os.environ.get('EXPENSIVE_CONCURRENCY', '64'))
+UPLOAD_CONCURRENCY = int(os.environ.get('UPLOAD_CONCURRENCY', '16'))
+UPLOAD_USER_CONCURRENCY = int(os.environ.get('UPLOAD_USER_CONCURRENCY', '2'))
+UPLOAD_READ_TIMEOUT_SECONDS = float(os.environ.get('UPLOAD_READ_TIMEOUT_SECONDS', '30'))
+RATE_LIMIT_KEYS = 100000
+
+rate_limited = register_metric(Counter(
+    "picochat_rate_limited_total", "Frames and requests refused by rate limits", ("limit",)
+))
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+    
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def take(self, amount: float = 1) -> float:
+        # Returns 0 when allowed, otherwise seconds until it would be
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate if self.rate > 0 else 60.0
+    
+    def wait_time(self) -> float:
+        # Budgets that may run into debt admit whenever the balance is positive
+        self._refill()
+        if self.tokens > 0:
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else 60.0
+    
+    def charge(self, amount: float):
+        self._refill()
+        self.tokens -= amount
+
+class RateLimiter:
+    def __init__(self, name: str, rate: tuple, max_keys: int = RATE_LIMIT_KEYS):
+        self.name = name
+        self.rate = rate
+        self.max_keys = max_keys
+        self.limited = 0
+        self._buckets = OrderedDict()
+    
+    def bucket(self, key: str) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(*self.rate)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+    
+    def take(self, key: str, amount: float = 1) -> float:
+        retry_after = self.bucket(key).take(amount)
+        if retry_after:
+            self.limited += 1
+            rate_limited.inc(self.name)
+        return retry_after
+    
+    def check(self, key: str) -> float:
+        retry_after = self.bucket(key).wait_time()
+        if retry_after:
+            self.limited += 1
+            rate_limited.inc(self.name)
+        return retry_after
+    
+    def charge(self, key: str, amount: float):
+        self.bucket(key).charge(amount)
+
+ws_frame_limiters = {t: RateLimiter(f"ws_{t}", rate) for t, rate in WS_USER_FRAME_RATES.items()}
+upload_request_limiter = RateLimiter("upload_requests", UPLOAD_REQUEST_RATE)
+upload_bytes_limiter = RateLimiter("upload_bytes", UPLOAD_BYTES_RATE)
+
+def too_many_requests(retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail="درخواست‌ها بیش از حد مجاز است، کمی بعد دوباره تلاش کنید",
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+def check_send_rate(user_id: str):
+    # REST sends share the websocket "message" budget
+    limiter = ws_frame_limiters.get("message")
+    retry_after = limiter.take(user_id) if limiter else 0.0
+    if retry_after:
+        raise too_many_requests(retry_after)
+
+async def limit_uploads(current_user: dict = Depends(get_current_user)) -> dict:
+    retry_after = upload_bytes_limiter.check(current_user["id"]) or upload_request_limiter.take(current_user["id"])
+    if retry_after:
+        raise too_many_requests(retry_after)
+    return current_user
+
+async def limit_upload_chunks(current_user: dict = Depends(get_current_user)) -> dict:
+    # Chunks of one resumable upload only count against the byte budget
+    retry_after = upload_bytes_limiter.check(current_user["id"])
+    if retry_after:
+        raise too_many_requests(retry_after)
+    return current_user
+
+class AdmissionControl:
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.in_flight = 0
+        self.rejected = 0
+    
+    def try_acquire(self) -> bool:
+        if self.in_flight >= self.limit:
+            self.rejected += 1
+            rate_limited.inc(self.name)
+            return False
+        self.in_flight += 1
+        return True
+    
+    def release(self):
+        self.in_flight -= 1
+    
+    def stats(self) -> dict:
+        return {"limit": self.limit, "in_flight": self.in_flight, "rejected": self.rejected}
+
+admission = AdmissionControl("concurrency", EXPENSIVE_CONCURRENCY)
+upload_admission = AdmissionControl("upload_concurrency", UPLOAD_CONCURRENCY)
+upload_user_slots = {}
+
+def server_busy() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="سرور شلوغ است، کمی بعد دوباره تلاش کنید",
+        headers={"Retry-After": "1"}
+    )
+
+async def expensive_request():
+    if not admission.try_acquire():
+        raise server_busy()
+    try:
+        yield
+    finally:
+        admission.release()
+
+async def upload_slot(current_user: dict = Depends(get_current_user)):
+    user_id = current_user["id"]
+    if upload_user_slots.get(user_id, 0) >= UPLOAD_USER_CONCURRENCY:
+        rate_limited.inc("upload_user_concurrency")
+        raise too_many_requests(1)
+    if not upload_admission.try_acquire():
+        raise server_busy()
+    upload_user_slots[user_id] = upload_user_slots.get(user_id, 0) + 1
+    try:
+        yield
+    finally:
+        upload_admission.release()
+        upload_user_slots[user_id] -= 1
+        if not upload_user_slots[user_id]:
+            del upload_user_slots[user_id]
+
+async def upload_stream(request: Request, limit: Optional[int] = None):
+    # The request body as it arrives, cut off once it passes `limit` bytes or
+    # stalls for UPLOAD_READ_TIMEOUT_SECONDS
+    chunks = request.stream().__aiter__()
+    received = 0
+    while True:
+        try:
+            chunk = await asyncio.wait_for(chunks.__anext__(), UPLOAD_READ_TIMEOUT_SECONDS)
+        except StopAsyncIteration:
+            return
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=408, detail="ارسال فایل متوقف شد")
+        received += len(chunk)
+        if limit is not None and received > limit:
+            raise HTTPException(status_code=413, detail="حجم فایل بیش از حد مجاز است")
+        yield chunk
+
+def rate_limit_stats() -> dict:
+    limiters = [*ws_frame_limiters.values(), upload_request_limiter, upload_bytes_limiter]
+    return {
+        "limited": {limiter.name: limiter.limited for limiter in limiters},
+        "admission": admission.stats(),
+        "upload_admission": upload_admission.stats()
+    }
+
+# ===================== CONVERSATION SUMMARY HELPERS =====================
+
+# Profile fields copied onto conversation documents so the chat list can be
+# rendered without a users lookup per participant.
+SNAPSHOT_FIELDS = ("id", "username", "display_name", "avatar")
+
+def user_snapshot(user: dict) -> dict:
+    return {field: user.get(field) for field in SNAPSHOT_FIELDS}
+
+def participant_response(snapshot: dict) -> UserResponse:
+    return UserResponse(
+        **snapshot,
+        is_online=presence.is_online(snapshot["id"]),
+        last_seen=presence.last_seen(snapshot["id"])
+    )
+
+def user_response(user: dict) -> UserResponse:
+    return UserResponse(**{
+        **user,
+        "is_online": presence.is_online_from_doc(user),
+        "last_seen": presence.last_seen(user["id"]) or user.get("last_seen")
+    })
+
+def conversation_is_stale(conv: dict) -> bool:
+    snapshots = conv.get("participant_snapshots") or {}
+    if any(pid not in snapshots for pid in conv["participants"]):
+        return True
+    return bool(conv.get("last_message_id")) and not conv.get("last_message")
+
+async def refresh_conversation_summaries(conversations: List[dict]):
+    # Fallback for documents written before summaries existed (or whose
+    # snapshots are missing a participant): bulk-fetch what is missing with a
+    # single $in per collection and backfill the documents.
+    stale = [conv for conv in conversations if conversation_is_stale(conv)]
+    if not stale:
+        return
+    
+    user_ids = {pid for conv in stale for pid in conv["participants"]}
+    message_ids = [conv["last_message_id"] for conv in stale if conv.get("last_message_id") and not conv.get("last_message")]
+    
+    users = await db.users.find(
+        {"id": {"$in": list(user_ids)}},
+        {"_id": 0, "password": 0}
+    ).to_list(None)
+    users_by_id = {u["id"]: u for u in users}
+    
+    messages_by_id = {}
+    if message_ids:
+        messages = await db.messages.find({"id": {"$in": message_ids}}, {"_id": 0}).to_list(None)
+        messages_by_id = {m["id"]: m for m in messages}
+    
+    for conv in stale:
+        update = {}
+        snapshots = conv.setdefault("participant_snapshots", {})
+        for pid in conv["participants"]:
+            if pid not in snapshots and pid in users_by_id:
+                snapshots[pid] = user_snapshot(users_by_id[pid])
+                update[f"participant_snapshots.{pid}"] = snapshots[pid]
+        
+        activity = {}
+        msg = messages_by_id.get(conv.get("last_message_id"))
+        if msg and not conv.get("last_message"):
+            conv["last_message"] = msg
+            update["last_message"] = msg
+            activity["last_activity"] = msg["timestamp"]
+        
+        if update:
+            await db.conversations.update_one(
+                {"id": conv["id"]}, {"$set": update, **({"$max": activity} if activity else {})}
+            )
+
+def message_status(msg: dict, conv: dict) -> str:
+    # Read state lives on the conversation as a per-participant watermark
+    # (read_upto); a message is read once every other participant's
+    # watermark has passed it. Messages marked read before watermarks
+    # existed keep their stored status.
+    if msg.get("status") == "read":
+        return "read"
+    read_upto = conv.get("read_upto") or {}
+    readers = [p for p in conv["participants"] if p != msg["sender_id"]]
+    if readers and all(read_upto.get(p, "") >= msg["timestamp"] for p in readers):
+        return "read"
+    return "sent"
+
+def message_response(msg: dict, conv: dict) -> MessageResponse:
+    return MessageResponse(**{**msg, "status": message_status(msg, conv)})
+
+async def mark_conversation_read(conversation_id: str, user_id: str) -> Optional[dict]:
+    # One write: move the reader's watermark up to the conversation's latest
+    # activity and clear their unread counter. The sequence number only moves
+    # when the watermark does, so repeated reads don't show up in syncs.
+    watermark = f"$read_upto.{user_id}"
+    return await db.conversations.find_one_and_update(
+        {"id": conversation_id},
+        [{"$set": {
+            f"read_upto.{user_id}": {"$max": [watermark, "$last_activity"]},
+            f"unread_count.{user_id}": 0,
+            "seq": {"$cond": [
+                {"$lt": [{"$ifNull": [watermark, ""]}, {"$ifNull": ["$last_activity", ""]}]},
+                {"$add": [{"$ifNull": ["$seq", 0]}, 1]},
+                {"$ifNull": ["$seq", 0]}
+            ]}
+        }}],
+        projection={"_id": 0, "id": 1, "participants": 1, "read_upto": 1, "seq": 1, "uncommitted_seq": 1, "archived_until": 1},
+        return_document=ReturnDocument.AFTER
+    )
+
+def conversation_response(conv: dict, user_id: str) -> ConversationResponse:
+    snapshots = conv.get("participant_snapshots") or {}
+    member_ids = conv["participants"]
+    if conv.get("type") == "group":
+        member_ids = member_ids[:GROUP_PREVIEW_MEMBERS]
+    participants = [participant_response(snapshots[pid]) for pid in member_ids if pid in snapshots]
+    last_msg = conv.get("last_message")
+    return ConversationResponse(
+        id=conv["id"],
+        type=conv.get("type", "direct"),
+        name=conv.get("name"),
+        created_by=conv.get("created_by"),
+        participants=participants,
+        member_count=len(conv["participants"]),
+        last_message=message_response(last_msg, conv) if last_msg else None,
+        unread_count=conv.get("unread_count", {}).get(user_id, 0),
+        seq=committed_seq(conv)
+    )
+
+def newer_than_summary(msg_doc: dict, seq) -> dict:
+    # Writes can land out of order; only a later message (by timestamp,
+    # then seq) may replace the summary
+    return {"$or": [
+        {"$lt": [{"$ifNull": ["$last_activity", ""]}, msg_doc["timestamp"]]},
+        {"$and": [
+            {"$eq": ["$last_activity", msg_doc["timestamp"]]},
+            {"$lt": [{"$ifNull": ["$last_message.seq", 0]}, seq]}
+        ]}
+    ]}
+
+def summary_fields(conv: dict, msg_doc: dict, seq) -> dict:
+    # One update bumps the unread counter of every other member. The
+    # summary only moves forward: last_activity is also the read
+    # watermark (see mark_conversation_read). `seq` may be an expression
+    # when the number is reserved in the same update.
+    newer = newer_than_summary(msg_doc, seq)
+    last_message = {**{k: {"$literal": v} for k, v in msg_doc.items()}, "seq": seq}
+    return {
+        "last_message_id": {"$cond": [newer, msg_doc["id"], "$last_message_id"]},
+        "last_message": {"$cond": [newer, last_message, "$last_message"]},
+        "last_activity": {"$max": ["$last_activity", msg_doc["timestamp"]]},
+        **{
+            f"unread_count.{p}": {"$add": [{"$ifNull": [f"$unread_count.{p}", 0]}, 1]}
+            for p in conv["participants"] if p != msg_doc["sender_id"]
+        }
+    }
+
+def conversation_update(conv: dict, msg_doc: dict) -> list:
+    return [{"$set": {
+        **summary_fields(conv, msg_doc, msg_doc["seq"]),
+        "uncommitted_seq": {"$filter": {
+            "input": {"$ifNull": ["$uncommitted_seq", []]},
+            "as": "r",
+            "cond": {"$ne": ["$$r.seq", msg_doc["seq"]]}
+        }}
+    }}]
+
+# Numbers reserved for messages stay in uncommitted_seq until the message is
+# stored, so clients are never told a sequence number
+# whose messages could still appear below it. Reservations whose writer died
+# stop holding the counter back after this long.
+SEQUENCE_COMMIT_TIMEOUT_SECONDS = float(os.environ.get('SEQUENCE_COMMIT_TIMEOUT_SECONDS', '30'))
+
+def sequence_reservation(count: int) -> dict:
+    # Pipeline fields that take the next `count` numbers from the
+    # conversation's counter and hold them in uncommitted_seq
+    now = datetime.now(timezone.utc)
+    cutoff = (now - timedelta(seconds=SEQUENCE_COMMIT_TIMEOUT_SECONDS)).isoformat()
+    seq = {"$ifNull": ["$seq", 0]}
+    return {
+        "seq": {"$add": [seq, count]},
+        "uncommitted_seq": {"$concatArrays": [
+            # Reservations left behind by dead writers are dropped here
+            {"$filter": {
+                "input": {"$ifNull": ["$uncommitted_seq", []]},
+                "as": "r",
+                "cond": {"$gt": ["$$r.at", cutoff]}
+            }},
+            {"$map": {
+                "input": {"$literal": list(range(1, count + 1))},
+                "as": "n",
+                "in": {"seq": {"$add": [seq, "$$n"]}, "at": now.isoformat()}
+            }}
+        ]}
+    }
+
+async def allocate_sequence(conversation_id: str, count: int = 1) -> int:
+    # Every message and read-state change in a conversation takes the next
+    # number from the conversation's counter; clients resume from the last
+    # one they saw. Reserves `count` numbers and returns the first.
+    conv = await db.conversations.find_one_and_update(
+        {"id": conversation_id}, [{"$set": sequence_reservation(count)}],
+        projection={"_id": 0, "seq": 1}, return_document=ReturnDocument.AFTER
+    )
+    return conv["seq"] - count + 1
+
+async def release_sequences(conversation_id: str, seqs: List[int]):
+    # Numbers of messages that will never be written
+    await db.conversations.update_one({"id": conversation_id}, {"$pull": {"uncommitted_seq": {"seq": {"$in": seqs}}}})
+
+def committed_seq(conv: dict) -> int:
+    # Highest number at or below which every message has committed
+    cutoff = (datetime.now(timezone.utc) - timedelta(seconds=SEQUENCE_COMMIT_TIMEOUT_SECONDS)).isoformat()
+    pending = [r["seq"] for r in conv.get("uncommitted_seq") or [] if r["at"] > cutoff]
+    return min([conv.get("seq", 0)] + [seq - 1 for seq in pending])
+
+def stored_message(msg_doc: dict) -> dict:
+    # The document written to Mongo carries the search index terms; the
+    # caller's dict stays as the client-facing payload
+    return {**msg_doc, "search_terms": search_terms(msg_doc.get("content"))}
+
+async def record_message(conv: dict, msg_doc: dict):
+    # Store the message and keep the conversation summary (last message,
+    # activity time, unread counters) in step with it.
+    if message_batcher.enabled:
+        return await message_batcher.submit(conv, msg_doc)
+    
+    # The number is reserved by the same write that moves the summary, so
+    # a send costs one conversation round trip; it stays uncommitted until
+    # the message is stored
+    before = await db.conversations.find_one_and_update(
+        {"id": conv["id"]},
+        [{"$set": {
+            **sequence_reservation(1),
+            **summary_fields(conv, msg_doc, {"$add": [{"$ifNull": ["$seq", 0]}, 1]})
+        }}],
+        projection={"_id": 0, "seq": 1, "last_message_id": 1, "last_message": 1, "last_activity": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    msg_doc["seq"] = (before.get("seq") or 0) + 1
+    try:
+        await db.messages.insert_one(stored_message(msg_doc))
+    except Exception:
+        await db.conversations.update_one({"id": conv["id"]}, undo_conversation_update(conv, msg_doc, before))
+        raise
+    
+    release = asyncio.create_task(commit_sequence(conv["id"], msg_doc["seq"]))
+    sequence_commits.add(release)
+    release.add_done_callback(sequence_commits.discard)
+
+def undo_conversation_update(conv: dict, msg_doc: dict, before: dict) -> list:
+    # The message was never stored: give its unread counts and number back
+    # and put the previous summary back unless a later message replaced it
+    ours = {"$eq": ["$last_message_id", msg_doc["id"]]}
+    return [{"$set": {
+        **{
+            field: {"$cond": [ours, {"$literal": before.get(field)}, f"${field}"]}
+            for field in ("last_message_id", "last_message", "last_activity")
+        },
+        **{
+            f"unread_count.{p}": {"$max": [0, {"$subtract": [{"$ifNull": [f"$unread_count.{p}", 0]}, 1]}]}
+            for p in conv["participants"] if p != msg_doc["sender_id"]
+        },
+        "uncommitted_seq": {"$filter": {
+            "input": {"$ifNull": ["$uncommitted_seq", []]},
+            "as": "r",
+            "cond": {"$ne": ["$$r.seq", msg_doc["seq"]]}
+        }}
+    }}]
+
+# Reservations of stored messages are released off the send path; one that
+# is lost only holds the counter back until SEQUENCE_COMMIT_TIMEOUT_SECONDS
+sequence_commits = set()
+
+async def commit_sequence(conversation_id: str, seq: int):
+    try:
+        await release_sequences(conversation_id, [seq])
+    except Exception:
+        logger.exception("Committing a message sequence number failed")
+
+# Optional group commit: with MESSAGE_BATCH_WINDOW_MS > 0, messages from all
+# connections are collected for up to that long (or MESSAGE_BATCH_MAX
+# messages) and written with one insert_many plus one ordered bulk_write.
+MESSAGE_BATCH_WINDOW_MS = float(os.environ.get('MESSAGE_BATCH_WINDOW_MS', '0'))
+MESSAGE_BATCH_MAX = int(os.environ.get('MESSAGE_BATCH_MAX', '100'))
+
+class MessageWriteBatcher:
+    def __init__(self, window_ms: float, max_size: int):
+        self.window = window_ms / 1000
+        self.max_size = max_size
+        self.batches = 0
+        self.messages = 0
+        self._pending = []
+        self._timer = None
+        self._commits = set()
+    
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+    
+    async def submit(self, conv: dict, msg_doc: dict):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((conv, msg_doc, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        # Resolves once the batch holding this message has committed
+        return await future
+    
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.create_task(self._commit(batch))
+        self._commits.add(task)
+        task.add_done_callback(self._commits.discard)
+    
+    async def _commit(self, batch: list):
+        error = None
+        try:
+            await self._allocate(batch)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        docs = [stored_message(msg_doc) for _, msg_doc, _ in batch]
+        inserted = len(docs)
+        try:
+            await db.messages.insert_many(docs, ordered=True)
+        except BulkWriteError as e:
+            # Ordered insert stops at the first failure; earlier ones are stored
+            inserted = e.details.get("nInserted", 0)
+            error = e
+        except Exception as e:
+            inserted = 0
+            error = e
+        
+        committed = batch[:inserted]
+        if committed:
+            operations = [UpdateOne({"id": conv["id"]}, conversation_update(conv, msg_doc)) for conv, msg_doc, _ in committed]
+            try:
+                await db.conversations.bulk_write(operations, ordered=True)
+            except Exception as e:
+                logger.exception("Conversation updates for a message batch failed")
+                error = error or e
+        
+        self.batches += 1
+        self.messages += len(committed)
+        for _, _, future in committed:
+            if not future.done():
+                future.set_result(None)
+        if isinstance(error, BulkWriteError) and inserted < len(batch):
+            # Only the message at the failure point is rejected; retry the rest
+            conv, msg_doc, failed = batch[inserted]
+            await self._release([(conv, msg_doc, failed)])
+            if not failed.done():
+                failed.set_exception(error)
+            if batch[inserted + 1:]:
+                await self._commit(batch[inserted + 1:])
+            return
+        await self._release(batch[inserted:])
+        for _, _, future in batch[inserted:]:
+            if not future.done():
+                future.set_exception(error)
+    
+    async def _release(self, rejected: list):
+        seqs = {}
+        for conv, msg_doc, _ in rejected:
+            seqs.setdefault(conv["id"], []).append(msg_doc["seq"])
+        try:
+            await asyncio.gather(*(release_sequences(conv_id, s) for conv_id, s in seqs.items()))
+        except Exception:
+            logger.exception("Releasing sequence numbers of rejected messages failed")
+    
+    async def _allocate(self, batch: list):
+        # One counter bump per conversation in the batch; messages retried
+        # after a partial failure keep the numbers they already have
+        counts = {}
+        for conv, msg_doc, _ in batch:
+            if "seq" not in msg_doc:
+                counts[conv["id"]] = counts.get(conv["id"], 0) + 1
+        firsts = await asyncio.gather(*(allocate_sequence(conv_id, n) for conv_id, n in counts.items()))
+        next_seq = dict(zip(counts, firsts))
+        for conv, msg_doc, _ in batch:
+            if "seq" not in msg_doc:
+                msg_doc["seq"] = next_seq[conv["id"]]
+                next_seq[conv["id"]] += 1
+    
+    async def drain(self):
+        self._flush()
+        if self._commits:
+            await asyncio.gather(*self._commits, return_exceptions=True)
+    
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "window_ms": self.window * 1000,
+            "batches": self.batches,
+            "messages": self.messages,
+            "pending": len(self._pending)
+        }
+
+message_batcher = MessageWriteBatcher(MESSAGE_BATCH_WINDOW_MS, MESSAGE_BATCH_MAX)
+
 # ===================== AUTH ROUTES =====================
 
 @api_router.post("/auth/register", response_model=TokenResponse)
@@ -138,15 +1150,19 @@ async def register(user_data: UserCreate):
     user_doc = {
         "id": user_id,
         "username": user_data.username,
-        "password": get_password_hash(user_data.password),
+        "password": await get_password_hash(user_data.password),
         "display_name": user_data.display_name,
         "avatar": None,
         "is_online": False,
         "last_seen": datetime.now(timezone.utc).isoformat(),
         "created_at": datetime.now(timezone.utc).isoformat()
     }
+    user_doc.update(directory_fields(user_data.username, user_data.display_name))
     
-    await db.users.insert_one(user_doc)
+    try:
+        await db.users.insert_one(user_doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="نام کاربری قبلاً استفاده شده است")
     
     token = create_access_token({"sub": user_id})
     user_response = UserResponse(
@@ -162,17 +1178,12 @@ async def register(user_data: UserCreate):
 @api_router.post("/auth/login", response_model=TokenResponse)
 async def login(user_data: UserLogin):
     user = await db.users.find_one({"username": user_data.username}, {"_id": 0})
-    if not user or not verify_password(user_data.password, user["password"]):
+    if not user or not await verify_password(user_data.password, user["password"]):
         raise HTTPException(status_code=401, detail="نام کاربری یا رمز عبور اشتباه است")
     
     token = create_access_token({"sub": user["id"]})
     
-    # Update online status
-    await db.users.update_one(
-        {"id": user["id"]},
-        {"$set": {"is_online": True, "last_seen": datetime.now(timezone.utc).isoformat()}}
-    )
-    
+    # Online status follows the websocket, which the client opens next
     user_response = UserResponse(
         id=user["id"],
         username=user["username"],
@@ -185,36 +1196,80 @@ async def login(user_data: UserLogin):
 
 @api_router.get("/auth/me", response_model=UserResponse)
 async def get_me(current_user: dict = Depends(get_current_user)):
-    return UserResponse(
-        id=current_user["id"],
-        username=current_user["username"],
-        display_name=current_user["display_name"],
-        avatar=current_user.get("avatar"),
-        is_online=current_user.get("is_online", False),
-        last_seen=current_user.get("last_seen")
-    )
+    return user_response(current_user)
 
 @api_router.post("/auth/logout")
 async def logout(current_user: dict = Depends(get_current_user)):
-    await db.users.update_one(
-        {"id": current_user["id"]},
-        {"$set": {"is_online": False, "last_seen": datetime.now(timezone.utc).isoformat()}}
-    )
+    presence.logged_out(current_user["id"])
+    user_cache.invalidate(current_user["id"])
     return {"message": "با موفقیت خارج شدید"}
 
 # ===================== USER ROUTES =====================
 
-@api_router.get("/users", response_model=List[UserResponse])
-async def get_users(current_user: dict = Depends(get_current_user)):
-    users = await db.users.find({"id": {"$ne": current_user["id"]}}, {"_id": 0, "password": 0}).to_list(100)
-    return [UserResponse(**u) for u in users]
+# The directory is ordered by the normalized username. Users also carry the
+# search terms of their username and display name (same normalization as
+# message search) so a prefix lookup is an index range scan.
+DIRECTORY_PROJECTION = {"_id": 0, "id": 1, "username": 1, "display_name": 1, "avatar": 1,
+                        "is_online": 1, "last_seen": 1, "username_key": 1}
+
+def directory_fields(username: str, display_name: str) -> dict:
+    return {
+        "username_key": normalize_search_text(username),
+        "directory_terms": list(dict.fromkeys(search_terms(username) + search_terms(display_name)))
+    }
+
+def encode_user_cursor(user: dict) -> str:
+    raw = f"{user['username_key']}|{user['id']}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_user_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        username_key, user_id = raw.rsplit("|", 1)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="cursor نامعتبر است")
+    return username_key, user_id
+
+@api_router.get("/users", response_model=UserPage)
+async def get_users(
+    q: Optional[str] = Query(None, max_length=100),
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=100),
+    current_user: dict = Depends(get_current_user)
+):
+    conditions = [{"id": {"$ne": current_user["id"]}}]
+    if q:
+        # Every word must match; the last one as a prefix
+        terms = search_terms(q, expand=False)[:5]
+        if not terms:
+            raise HTTPException(status_code=400, detail="عبارت جستجو معتبر نیست")
+        *exact, last = terms
+        conditions.extend({"directory_terms": term} for term in exact)
+        conditions.append({"directory_terms": {"$regex": f"^{re.escape(last)}"}})
+    if cursor:
+        username_key, user_id = decode_user_cursor(cursor)
+        conditions.append({"$or": [
+            {"username_key": {"$gt": username_key}},
+            {"username_key": username_key, "id": {"$gt": user_id}}
+        ]})
+    
+    users = await db.users.find({"$and": conditions}, DIRECTORY_PROJECTION).sort(
+        [("username_key", 1), ("id", 1)]
+    ).limit(limit + 1).to_list(limit + 1)
+    
+    has_more = len(users) > limit
+    users = users[:limit]
+    return UserPage(
+        users=[user_response(u) for u in users],
+        next_cursor=encode_user_cursor(users[-1]) if has_more else None
+    )
 
 @api_router.get("/users/{user_id}", response_model=UserResponse)
 async def get_user(user_id: str, current_user: dict = Depends(get_current_user)):
     user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
     if not user:
         raise HTTPException(status_code=404, detail="کاربر یافت نشد")
-    return UserResponse(**user)
+    return user_response(user)
 
 @api_router.put("/users/profile")
 async def update_profile(display_name: str = None, current_user: dict = Depends(get_current_user)):
@@ -223,7 +1278,14 @@ async def update_profile(display_name: str = None, current_user: dict = Depends(
         update_data["display_name"] = display_name
     
     if update_data:
-        await db.users.update_one({"id": current_user["id"]}, {"$set": update_data})
+        directory = directory_fields(current_user["username"], update_data.get("display_name", current_user["display_name"]))
+        await db.users.update_one({"id": current_user["id"]}, {"$set": {**update_data, **directory}})
+        user_cache.invalidate(current_user["id"])
+        # Keep the profile snapshots on the user's conversations current
+        await db.conversations.update_many(
+            {"participants": current_user["id"]},
+            {"$set": {f"participant_snapshots.{current_user['id']}.{k}": v for k, v in update_data.items()}}
+        )
     
     return {"message": "پروفایل به‌روزرسانی شد"}
 
@@ -234,114 +1296,305 @@ async def get_conversations(current_user: dict = Depends(get_current_user)):
     conversations = await db.conversations.find(
         {"participants": current_user["id"]},
         {"_id": 0}
-    ).to_list(100)
+    ).sort("last_activity", -1).to_list(100)
     
-    result = []
-    for conv in conversations:
-        participants = []
-        for pid in conv["participants"]:
-            p = await db.users.find_one({"id": pid}, {"_id": 0, "password": 0})
-            if p:
-                participants.append(UserResponse(**p))
-        
-        last_msg = None
-        if conv.get("last_message_id"):
-            msg = await db.messages.find_one({"id": conv["last_message_id"]}, {"_id": 0})
-            if msg:
-                last_msg = MessageResponse(**msg)
-        
-        result.append(ConversationResponse(
-            id=conv["id"],
-            participants=participants,
-            last_message=last_msg,
-            unread_count=conv.get("unread_count", {}).get(current_user["id"], 0)
-        ))
+    await refresh_conversation_summaries(conversations)
     
-    return result
+    return [conversation_response(conv, current_user["id"]) for conv in conversations]
 
 @api_router.post("/conversations/{other_user_id}", response_model=ConversationResponse)
 async def create_or_get_conversation(other_user_id: str, current_user: dict = Depends(get_current_user)):
-    # Check if conversation exists
+    # Check if conversation exists (groups with both users don't count)
     existing = await db.conversations.find_one({
-        "participants": {"$all": [current_user["id"], other_user_id]}
+        "participants": {"$all": [current_user["id"], other_user_id], "$size": 2},
+        "type": {"$ne": "group"}
     }, {"_id": 0})
     
     if existing:
-        participants = []
-        for pid in existing["participants"]:
-            p = await db.users.find_one({"id": pid}, {"_id": 0, "password": 0})
-            if p:
-                participants.append(UserResponse(**p))
-        return ConversationResponse(
-            id=existing["id"],
-            participants=participants,
-            unread_count=0
-        )
+        await refresh_conversation_summaries([existing])
+        response = conversation_response(existing, current_user["id"])
+        response.unread_count = 0
+        return response
+    
+    other_user = await db.users.find_one({"id": other_user_id}, {"_id": 0, "password": 0})
+    if not other_user:
+        raise HTTPException(status_code=404, detail="کاربر یافت نشد")
     
     # Create new conversation
     conv_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc).isoformat()
     conv_doc = {
         "id": conv_id,
         "participants": [current_user["id"], other_user_id],
+        "participant_snapshots": {
+            current_user["id"]: user_snapshot(current_user),
+            other_user_id: user_snapshot(other_user)
+        },
         "last_message_id": None,
+        "last_message": None,
+        "last_activity": now,
         "unread_count": {current_user["id"]: 0, other_user_id: 0},
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "seq": 0,
+        "created_at": now
     }
     
     await db.conversations.insert_one(conv_doc)
+    conversation_cache.invalidate(conv_id)
+    contacts_cache.invalidate(current_user["id"])
+    contacts_cache.invalidate(other_user_id)
     
-    participants = []
-    for pid in [current_user["id"], other_user_id]:
-        p = await db.users.find_one({"id": pid}, {"_id": 0, "password": 0})
-        if p:
-            participants.append(UserResponse(**p))
-    
-    return ConversationResponse(id=conv_id, participants=participants, unread_count=0)
-
-# ===================== MESSAGE ROUTES =====================
+    return conversation_response(conv_doc, current_user["id"])
 
-@api_router.get("/messages/{conversation_id}", response_model=List[MessageResponse])
-async def get_messages(conversation_id: str, current_user: dict = Depends(get_current_user)):
-    # Verify user is part of conversation
-    conv = await db.conversations.find_one({"id": conversation_id}, {"_id": 0})
-    if not conv or current_user["id"] not in conv["participants"]:
+async def get_group_for_user(conversation_id: str, user_id: str) -> dict:
+    conv = await db.conversations.find_one({"id": conversation_id, "type": "group"}, {"_id": 0})
+    if not conv:
+        raise HTTPException(status_code=404, detail="گروه یافت نشد")
+    if user_id not in conv["participants"]:
         raise HTTPException(status_code=403, detail="دسترسی ندارید")
+    return conv
+
+async def group_users(member_ids: List[str]) -> List[dict]:
+    ids = list(dict.fromkeys(member_ids))
+    users = await db.users.find({"id": {"$in": ids}}, {"_id": 0, "password": 0}).to_list(None)
+    if len(users) != len(ids):
+        raise HTTPException(status_code=404, detail="کاربر یافت نشد")
+    return users
+
+async def publish_group_update(conv_id: str, user_ids: List[str]):
+    # Every worker drops its cached membership (see deliver_local); members
+    # re-fetch the conversation or pick it up on their next sync
+    await manager.publish({"type": "conversation_updated", "conversation_id": conv_id}, user_ids)
+
+@api_router.post("/groups", response_model=ConversationResponse)
+async def create_group(data: GroupCreate, current_user: dict = Depends(get_current_user)):
+    member_ids = [m for m in dict.fromkeys(data.member_ids) if m != current_user["id"]]
+    if len(member_ids) + 1 > GROUP_MAX_MEMBERS:
+        raise HTTPException(status_code=400, detail=f"گروه حداکثر {GROUP_MAX_MEMBERS} عضو دارد")
+    members = [current_user] + await group_users(member_ids)
     
-    messages = await db.messages.find(
-        {"conversation_id": conversation_id},
-        {"_id": 0}
-    ).sort("timestamp", 1).to_list(1000)
+    conv_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc).isoformat()
+    conv_doc = {
+        "id": conv_id,
+        "type": "group",
+        "name": data.name,
+        "created_by": current_user["id"],
+        "participants": [m["id"] for m in members],
+        "participant_snapshots": {m["id"]: user_snapshot(m) for m in members},
+        "last_message_id": None,
+        "last_message": None,
+        "last_activity": now,
+        "unread_count": {m["id"]: 0 for m in members},
+        "seq": 0,
+        "created_at": now
+    }
     
-    # Mark messages as read
-    await db.messages.update_many(
-        {"conversation_id": conversation_id, "sender_id": {"$ne": current_user["id"]}},
-        {"$set": {"status": "read"}}
+    await db.conversations.insert_one(conv_doc)
+    for m in members:
+        contacts_cache.invalidate(m["id"])
+    await publish_group_update(conv_id, conv_doc["participants"])
+    
+    return conversation_response(conv_doc, current_user["id"])
+
+def encode_member_cursor(offset: int) -> str:
+    return base64.urlsafe_b64encode(str(offset).encode()).decode().rstrip("=")
+
+def decode_member_cursor(cursor: str) -> int:
+    try:
+        offset = int(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode())
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="cursor نامعتبر است")
+    if offset < 0:
+        raise HTTPException(status_code=400, detail="cursor نامعتبر است")
+    return offset
+
+@api_router.get("/groups/{conversation_id}/members", response_model=UserPage)
+async def get_group_members(
+    conversation_id: str,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=500),
+    current_user: dict = Depends(get_current_user)
+):
+    # Paged in join order by position, so a page may shift by the members
+    # removed since the previous one
+    conv = await get_conversation_for_user(conversation_id, current_user["id"])
+    offset = decode_member_cursor(cursor) if cursor else 0
+    page_ids = conv["participants"][offset:offset + limit]
+    group = await db.conversations.find_one(
+        {"id": conversation_id, "type": "group"},
+        {"_id": 0, **{f"participant_snapshots.{pid}": 1 for pid in page_ids}}
+    )
+    if not group:
+        raise HTTPException(status_code=404, detail="گروه یافت نشد")
+    snapshots = group.get("participant_snapshots") or {}
+    has_more = offset + limit < len(conv["participants"])
+    return UserPage(
+        users=[participant_response(snapshots[pid]) for pid in page_ids if pid in snapshots],
+        next_cursor=encode_member_cursor(offset + limit) if has_more else None
     )
+
+@api_router.post("/groups/{conversation_id}/members", response_model=ConversationResponse)
+async def add_group_members(conversation_id: str, data: GroupMembers, current_user: dict = Depends(get_current_user)):
+    conv = await get_group_for_user(conversation_id, current_user["id"])
+    if conv.get("created_by") != current_user["id"]:
+        raise HTTPException(status_code=403, detail="فقط سازنده گروه می‌تواند عضو اضافه کند")
+    
+    new_ids = [m for m in dict.fromkeys(data.member_ids) if m not in conv["participants"]]
+    if not new_ids:
+        return conversation_response(conv, current_user["id"])
+    if len(conv["participants"]) + len(new_ids) > GROUP_MAX_MEMBERS:
+        raise HTTPException(status_code=400, detail=f"گروه حداکثر {GROUP_MAX_MEMBERS} عضو دارد")
+    members = await group_users(new_ids)
     
-    # Reset unread count
-    await db.conversations.update_one(
+    update = {}
+    for m in members:
+        update[f"participant_snapshots.{m['id']}"] = user_snapshot(m)
+        update[f"unread_count.{m['id']}"] = 0
+    conv = await db.conversations.find_one_and_update(
         {"id": conversation_id},
-        {"$set": {f"unread_count.{current_user['id']}": 0}}
+        {"$addToSet": {"participants": {"$each": new_ids}}, "$set": update, "$inc": {"seq": 1}},
+        projection={"_id": 0}, return_document=ReturnDocument.AFTER
     )
     
-    return [MessageResponse(**m) for m in messages]
+    conversation_cache.invalidate(conversation_id)
+    for pid in conv["participants"]:
+        contacts_cache.invalidate(pid)
+    await publish_group_update(conversation_id, conv["participants"])
+    
+    return conversation_response(conv, current_user["id"])
+
+@api_router.delete("/groups/{conversation_id}/members/{user_id}")
+async def remove_group_member(conversation_id: str, user_id: str, current_user: dict = Depends(get_current_user)):
+    conv = await get_group_for_user(conversation_id, current_user["id"])
+    if user_id != current_user["id"] and conv.get("created_by") != current_user["id"]:
+        raise HTTPException(status_code=403, detail="فقط سازنده گروه می‌تواند عضو حذف کند")
+    if user_id not in conv["participants"]:
+        raise HTTPException(status_code=404, detail="کاربر عضو گروه نیست")
+    
+    remaining = [p for p in conv["participants"] if p != user_id]
+    update = {
+        "$pull": {"participants": user_id},
+        "$unset": {
+            f"participant_snapshots.{user_id}": "",
+            f"unread_count.{user_id}": "",
+            f"read_upto.{user_id}": ""
+        },
+        "$inc": {"seq": 1}
+    }
+    # A group whose creator leaves is handed to the longest-standing member
+    if user_id == conv.get("created_by") and remaining:
+        update["$set"] = {"created_by": remaining[0]}
+    await db.conversations.update_one({"id": conversation_id}, update)
+    
+    conversation_cache.invalidate(conversation_id)
+    for pid in conv["participants"]:
+        contacts_cache.invalidate(pid)
+    await publish_group_update(conversation_id, conv["participants"])
+    
+    return {"message": "عضو از گروه حذف شد"}
+
+# ===================== MESSAGE ROUTES =====================
+
+def encode_cursor(msg: dict) -> str:
+    raw = f"{msg['timestamp']}|{msg['id']}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        timestamp, msg_id = raw.split("|", 1)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="cursor نامعتبر است")
+    return timestamp, msg_id
+
+def keyset_filter(timestamp: str, msg_id: str, op: str) -> dict:
+    # Keyset condition on (timestamp, id) so ties on timestamp stay stable
+    return {"$or": [
+        {"timestamp": {op: timestamp}},
+        {"timestamp": timestamp, "id": {op: msg_id}}
+    ]}
+
+def cursor_filter(cursor: str, op: str) -> dict:
+    return keyset_filter(*decode_cursor(cursor), op)
+
+@api_router.get("/messages/{conversation_id}", response_model=MessagePage, dependencies=[Depends(expensive_request)])
+async def get_messages(
+    conversation_id: str,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    current_user: dict = Depends(get_current_user)
+):
+    # Verify user is part of conversation
+    await get_conversation_for_user(conversation_id, current_user["id"])
+    
+    if before and after:
+        raise HTTPException(status_code=400, detail="before و after را همزمان نفرستید")
+    
+    if not before:
+        # Mark messages as read
+        conv = await mark_conversation_read(conversation_id, current_user["id"])
+    else:
+        conv = await db.conversations.find_one(
+            {"id": conversation_id},
+            {"_id": 0, "id": 1, "participants": 1, "read_upto": 1, "archived_until": 1}
+        )
+    
+    # Without a cursor the newest page is returned; `before` walks back
+    # through history and `after` walks forward from a known message.
+    cursor = after or before
+    direction = 1 if after else -1
+    query = {"conversation_id": conversation_id}
+    if cursor:
+        query.update(cursor_filter(cursor, "$gt" if after else "$lt"))
+    if conv.get("archived_until"):
+        query["timestamp"] = {"$gte": conv["archived_until"]}
+    
+    # Archived history is older than every live message: walking back it
+    # follows the live page, walking forward it comes first
+    messages = []
+    if direction == 1 and cursor and decode_cursor(cursor)[0] < conv.get("archived_until", ""):
+        messages = await archived_history(conv, cursor, direction, limit + 1)
+    if len(messages) <= limit:
+        messages += await db.messages.find(query, {"_id": 0, "search_terms": 0}).sort(
+            [("timestamp", direction), ("id", direction)]
+        ).limit(limit + 1 - len(messages)).to_list(limit + 1 - len(messages))
+    if direction == -1 and len(messages) <= limit:
+        older_than = encode_cursor(messages[-1]) if messages else cursor
+        messages += await archived_history(conv, older_than, direction, limit + 1 - len(messages))
+    
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    next_cursor = encode_cursor(messages[-1]) if has_more else None
+    if direction == -1:
+        messages.reverse()
+    
+    return MessagePage(
+        messages=[message_response(m, conv) for m in messages],
+        next_cursor=next_cursor
+    )
+
+async def get_reply_data(reply_to: Optional[str], conversation_id: str) -> Optional[dict]:
+    if not reply_to:
+        return None
+    reply_msg = await db.messages.find_one({"id": reply_to}, {"_id": 0})
+    if not reply_msg:
+        reply_msg = await find_archived_message(conversation_id, reply_to)
+    if not reply_msg:
+        return None
+    return {
+        "id": reply_msg["id"],
+        "content": reply_msg.get("content"),
+        "sender_name": reply_msg["sender_name"],
+        "type": reply_msg["type"]
+    }
 
 @api_router.post("/messages/{conversation_id}", response_model=MessageResponse)
 async def send_message(conversation_id: str, message: MessageCreate, current_user: dict = Depends(get_current_user)):
-    conv = await db.conversations.find_one({"id": conversation_id}, {"_id": 0})
-    if not conv or current_user["id"] not in conv["participants"]:
-        raise HTTPException(status_code=403, detail="دسترسی ندارید")
+    conv = await get_conversation_for_user(conversation_id, current_user["id"])
+    check_send_rate(current_user["id"])
     
-    reply_data = None
-    if message.reply_to:
-        reply_msg = await db.messages.find_one({"id": message.reply_to}, {"_id": 0})
-        if reply_msg:
-            reply_data = {
-                "id": reply_msg["id"],
-                "content": reply_msg.get("content"),
-                "sender_name": reply_msg["sender_name"],
-                "type": reply_msg["type"]
-            }
+    reply_data = await get_reply_data(message.reply_to, conversation_id)
     
     msg_id = str(uuid.uuid4())
     timestamp = datetime.now(timezone.utc).isoformat()
@@ -359,224 +1612,1972 @@ async def send_message(conversation_id: str, message: MessageCreate, current_use
         "status": "sent"
     }
     
-    await db.messages.insert_one(msg_doc)
-    
-    # Update conversation
-    other_user_id = [p for p in conv["participants"] if p != current_user["id"]][0]
-    await db.conversations.update_one(
-        {"id": conversation_id},
-        {
-            "$set": {"last_message_id": msg_id},
-            "$inc": {f"unread_count.{other_user_id}": 1}
-        }
-    )
+    await record_message(conv, msg_doc)
+    await manager.publish({"type": "new_message", "message": msg_doc}, conv["participants"])
     
     return MessageResponse(**msg_doc)
 
-@api_router.post("/upload/{conversation_id}")
-async def upload_file(
-    conversation_id: str,
-    file: UploadFile = File(...),
-    reply_to: Optional[str] = None,
+# ===================== SEARCH =====================
+
+# Messages store a normalized term list (search_terms) behind a multikey
+# index. Normalization folds Arabic letter forms into Persian ones, strips
+# diacritics and tatweel, unifies digits and handles ZWNJ: a word written
+# with a half-space is indexed joined and as its parts, so "می‌روم",
+# "میروم" and "می روم" all find it.
+SEARCH_CHAR_MAP = str.maketrans({
+    "ي": "ی", "ى": "ی", "ئ": "ی",
+    "ك": "ک",
+    "ة": "ه", "ۀ": "ه",
+    "أ": "ا", "إ": "ا", "ٱ": "ا",
+    "ؤ": "و",
+    **{chr(0x06F0 + i): str(i) for i in range(10)},
+    **{chr(0x0660 + i): str(i) for i in range(10)},
+    "\u0640": None,  # tatweel
+    "\u200d": None,  # zero-width joiner
+})
+SEARCH_DIACRITICS = re.compile("[\u064B-\u065F\u0670\u06D6-\u06ED]")
+SEARCH_SPLIT = re.compile("[^\\w\u200c]+")
+SEARCH_MAX_TERMS = 200
+SEARCH_MAX_TERM_LENGTH = 64
+
+def normalize_search_text(text: str) -> str:
+    return SEARCH_DIACRITICS.sub("", text.translate(SEARCH_CHAR_MAP)).casefold()
+
+def search_terms(text: Optional[str], expand: bool = True) -> List[str]:
+    if not text:
+        return []
+    terms = []
+    for token in SEARCH_SPLIT.split(normalize_search_text(text)):
+        parts = [p for p in token.split("\u200c") if p]
+        if not parts:
+            continue
+        terms.append("".join(parts)[:SEARCH_MAX_TERM_LENGTH])
+        if expand and len(parts) > 1:
+            terms.extend(p[:SEARCH_MAX_TERM_LENGTH] for p in parts)
+    return list(dict.fromkeys(terms))[:SEARCH_MAX_TERMS]
+
+# Ranking: messages containing the last word as a whole term come first,
+# newest first, then messages where it only matches as a prefix. Each tier
+# is a separate keyset scan; the exact tier walks the search index in sort
+# order. A last word shorter than SEARCH_MIN_PREFIX_LENGTH only matches
+# whole terms, so a one-letter query never turns into a wide regex scan.
+SEARCH_MIN_PREFIX_LENGTH = 2
+
+def encode_search_cursor(tier: str, msg: Optional[dict]) -> str:
+    raw = f"{tier}|{msg['timestamp']}|{msg['id']}" if msg else f"{tier}||"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_search_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        tier, timestamp, msg_id = raw.split("|", 2)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="cursor نامعتبر است")
+    if tier not in ("exact", "prefix"):
+        raise HTTPException(status_code=400, detail="cursor نامعتبر است")
+    return tier, (timestamp, msg_id) if timestamp else None
+
+def search_match(terms: List[str], exact: List[str], last: str, tier: str) -> bool:
+    if not all(term in terms for term in exact):
+        return False
+    if tier == "exact":
+        return last in terms
+    return last not in terms and any(term.startswith(last) for term in terms)
+
+async def search_archive(convs_by_id: dict, exact: List[str], last: str, tier: str, position: Optional[tuple], limit: int) -> List[dict]:
+    # Buckets carry the union of their messages' terms, so a bucket match is
+    # only a candidate; the messages in it are checked one by one
+    archived = [c["id"] for c in convs_by_id.values() if c.get("archived_until")]
+    conditions = [{"search_terms": term} for term in exact]
+    if tier == "exact":
+        conditions.append({"search_terms": last})
+    else:
+        conditions.append({"search_terms": {"$regex": f"^{re.escape(last)}"}})
+    query = {"conversation_id": {"$in": archived}, "$and": conditions}
+    if position:
+        query["start_ts"] = {"$lte": position[0]}
+    
+    matches = []
+    buckets = db.message_buckets.find(
+        query, {"_id": 0, "conversation_id": 1, "start_ts": 1, "end_ts": 1, "data": 1}
+    ).sort("end_ts", -1)
+    async for bucket in buckets:
+        if len(matches) >= limit and bucket["end_ts"] < matches[limit - 1]["timestamp"]:
+            break
+        if bucket["start_ts"] >= convs_by_id[bucket["conversation_id"]]["archived_until"]:
+            continue
+        for msg in unpack_bucket(bucket):
+            if position and archive_key(msg) >= position:
+                continue
+            if search_match(search_terms(msg.get("content")), exact, last, tier):
+                matches.append(msg)
+        matches.sort(key=archive_key, reverse=True)
+    return matches[:limit]
+
+async def search_tier(convs_by_id: dict, exact: List[str], last: str, tier: str, position: Optional[tuple], limit: int) -> List[dict]:
+    if tier == "exact":
+        query = {"search_terms": {"$all": exact + [last]}}
+    else:
+        query = {"$and": [{"search_terms": term} for term in exact] + [
+            {"search_terms": {"$regex": f"^{re.escape(last)}"}},
+            {"search_terms": {"$ne": last}}
+        ]}
+    query["conversation_id"] = {"$in": list(convs_by_id)}
+    if position:
+        query.update(keyset_filter(*position, "$lt"))
+    messages = await db.messages.find(query, {"_id": 0, "search_terms": 0}).sort(
+        [("timestamp", -1), ("id", -1)]
+    ).limit(limit).to_list(limit)
+    if any(c.get("archived_until") for c in convs_by_id.values()):
+        messages = sorted(
+            messages + await search_archive(convs_by_id, exact, last, tier, position, limit),
+            key=archive_key, reverse=True
+        )[:limit]
+    return messages
+
+@api_router.get("/search", response_model=SearchPage, dependencies=[Depends(expensive_request)])
+async def search_messages(
+    q: str = Query(min_length=1, max_length=200),
+    conversation_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
     current_user: dict = Depends(get_current_user)
 ):
-    conv = await db.conversations.find_one({"id": conversation_id}, {"_id": 0})
-    if not conv or current_user["id"] not in conv["participants"]:
-        raise HTTPException(status_code=403, detail="دسترسی ندارید")
+    terms = search_terms(q, expand=False)[:10]
+    if not terms:
+        raise HTTPException(status_code=400, detail="عبارت جستجو معتبر نیست")
+    tier, position = decode_search_cursor(cursor) if cursor else ("exact", None)
+    
+    conv_filter = {"participants": current_user["id"]}
+    if conversation_id:
+        conv_filter["id"] = conversation_id
+    conversations = await db.conversations.find(
+        conv_filter, {"_id": 0, "id": 1, "participants": 1, "read_upto": 1, "archived_until": 1}
+    ).to_list(None)
+    if not conversations:
+        return SearchPage(results=[])
+    convs_by_id = {c["id"]: c for c in conversations}
+    
+    # Every word must match; the last one also matches as a prefix so
+    # results show up while the user is still typing
+    *exact, last = terms
+    with_prefix = len(last) >= SEARCH_MIN_PREFIX_LENGTH
+    messages, next_cursor = [], None
+    if tier == "exact":
+        messages = await search_tier(convs_by_id, exact, last, "exact", position, limit + 1)
+        if len(messages) > limit:
+            messages = messages[:limit]
+            next_cursor = encode_search_cursor("exact", messages[-1])
+        elif with_prefix:
+            tier, position = "prefix", None
+    if tier == "prefix" and with_prefix and not next_cursor:
+        remaining = limit - len(messages)
+        found = await search_tier(convs_by_id, exact, last, "prefix", position, remaining + 1)
+        if len(found) > remaining:
+            found = found[:remaining]
+            next_cursor = encode_search_cursor("prefix", found[-1] if found else None)
+        messages += found
+    
+    return SearchPage(
+        results=[
+            SearchResult(**{**m, "status": message_status(m, convs_by_id[m["conversation_id"]])})
+            for m in messages
+        ],
+        next_cursor=next_cursor
+    )
+
+# ===================== SYNC =====================
+
+# Catch-up after a reconnect: the client sends the last sequence number it
+# saw per conversation and gets back only what changed since. Conversations
+# missing from `since` are returned in full summary form. Per conversation
+# at most SYNC_MESSAGE_LIMIT messages come back; with has_more the client
+# syncs again from the returned seq.
+SYNC_MESSAGE_LIMIT = int(os.environ.get('SYNC_MESSAGE_LIMIT', '200'))
+
+async def sync_conversations(user_id: str, since: dict) -> SyncResponse:
+    heads = await db.conversations.find(
+        {"participants": user_id}, {"_id": 0, "id": 1, "seq": 1, "uncommitted_seq": 1}
+    ).to_list(None)
+    changed = []
+    for head in heads:
+        known = since.get(head["id"])
+        if not isinstance(known, int) or committed_seq(head) > known:
+            changed.append(head["id"])
+    if not changed:
+        return SyncResponse(conversations=[])
+    
+    convs = await db.conversations.find({"id": {"$in": changed}}, {"_id": 0}).to_list(None)
+    await refresh_conversation_summaries(convs)
+    
+    async def missed(conv: dict) -> list:
+        known = since.get(conv["id"])
+        if not isinstance(known, int):
+            return []
+        # Clients that were away long enough resume partly from the archive
+        messages = await archived_since_seq(conv, known, SYNC_MESSAGE_LIMIT + 1)
+        remaining = SYNC_MESSAGE_LIMIT + 1 - len(messages)
+        if remaining > 0:
+            # Messages past the committed mark are left for the next sync
+            messages += await db.messages.find(
+                {"conversation_id": conv["id"], "seq": {"$gt": known, "$lte": committed_seq(conv)}},
+                {"_id": 0, "search_terms": 0}
+            ).sort("seq", 1).limit(remaining).to_list(remaining)
+        return messages
+    
+    pages = await asyncio.gather(*(missed(conv) for conv in convs))
+    
+    result = []
+    for conv, messages in zip(convs, pages):
+        has_more = len(messages) > SYNC_MESSAGE_LIMIT
+        messages = messages[:SYNC_MESSAGE_LIMIT]
+        seq = messages[-1]["seq"] if has_more else committed_seq(conv)
+        result.append(ConversationSync(
+            conversation=conversation_response(conv, user_id),
+            messages=[message_response(m, conv) for m in messages],
+            read_upto=conv.get("read_upto") or {},
+            seq=seq,
+            has_more=has_more
+        ))
+    return SyncResponse(conversations=result)
+
+@api_router.post("/sync", response_model=SyncResponse, dependencies=[Depends(expensive_request)])
+async def sync(request: SyncRequest, current_user: dict = Depends(get_current_user)):
+    return await sync_conversations(current_user["id"], request.since)
+
+# ===================== MESSAGE ARCHIVE =====================
+
+# Messages older than MESSAGE_ARCHIVE_AFTER_DAYS are rolled, one UTC day at a
+# time, into zlib-compressed bucket documents of up to MESSAGE_BUCKET_SIZE
+# messages. conversation.archived_until marks the boundary: older history
+# lives only in buckets, newer only in db.messages, so reads can merge the
+# two without duplicates. Buckets keep the ids, search terms and file URLs of
+# their messages in plain fields for replies, search and media checks.
+MESSAGE_ARCHIVE_AFTER_DAYS = float(os.environ.get('MESSAGE_ARCHIVE_AFTER_DAYS', '90'))
+MESSAGE_BUCKET_SIZE = int(os.environ.get('MESSAGE_BUCKET_SIZE', '500'))
+MESSAGE_ARCHIVE_INTERVAL_SECONDS = float(os.environ.get('MESSAGE_ARCHIVE_INTERVAL_SECONDS', '3600'))
+
+def pack_bucket(conversation_id: str, day: str, part: int, messages: List[dict]) -> dict:
+    body = [{k: v for k, v in m.items() if k not in ("_id", "conversation_id", "search_terms")} for m in messages]
+    terms = {term for m in messages for term in m.get("search_terms", [])}
+    file_urls = {m["file_url"] for m in messages if m.get("file_url")}
+    file_urls.update(m["preview"]["thumbnail_url"] for m in messages if (m.get("preview") or {}).get("thumbnail_url"))
+    return {
+        "id": f"{conversation_id}:{day}:{part}",
+        "conversation_id": conversation_id,
+        "start_ts": messages[0]["timestamp"],
+        "end_ts": messages[-1]["timestamp"],
+        "start_seq": min(m.get("seq", 0) for m in messages),
+        "end_seq": max(m.get("seq", 0) for m in messages),
+        "count": len(messages),
+        "message_ids": [m["id"] for m in messages],
+        "search_terms": sorted(terms),
+        "file_urls": sorted(file_urls),
+        "data": zlib.compress(json.dumps(body, separators=(",", ":"), ensure_ascii=False).encode(), 9),
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+
+def unpack_bucket(bucket: dict) -> List[dict]:
+    messages = json.loads(zlib.decompress(bucket["data"]))
+    for msg in messages:
+        msg["conversation_id"] = bucket["conversation_id"]
+    return messages
+
+def archive_key(msg: dict) -> tuple:
+    return (msg["timestamp"], msg["id"])
+
+async def archived_history(conv: dict, cursor: Optional[str], direction: int, limit: int) -> List[dict]:
+    # Up to `limit` archived messages past the cursor, in `direction` order
+    archived_until = conv.get("archived_until")
+    if not archived_until:
+        return []
+    query = {"conversation_id": conv["id"], "start_ts": {"$lt": archived_until}}
+    position = decode_cursor(cursor) if cursor else None
+    if position and direction == -1:
+        query["start_ts"]["$lte"] = position[0]
+    elif position:
+        query["end_ts"] = {"$gte": position[0]}
     
-    # Determine file type
-    content_type = file.content_type or ""
+    messages = []
+    buckets = db.message_buckets.find(query, {"_id": 0, "conversation_id": 1, "data": 1}).sort("start_ts", direction)
+    async for bucket in buckets:
+        unpacked = unpack_bucket(bucket)
+        if direction == -1:
+            unpacked.reverse()
+        for msg in unpacked:
+            if position and (archive_key(msg) >= position if direction == -1 else archive_key(msg) <= position):
+                continue
+            messages.append(msg)
+            if len(messages) >= limit:
+                return messages
+    return messages
+
+async def archived_since_seq(conv: dict, seq: int, limit: int) -> List[dict]:
+    if not conv.get("archived_until"):
+        return []
+    messages = []
+    buckets = db.message_buckets.find(
+        {"conversation_id": conv["id"], "start_ts": {"$lt": conv["archived_until"]}, "end_seq": {"$gt": seq}},
+        {"_id": 0, "conversation_id": 1, "data": 1}
+    ).sort("start_ts", 1)
+    async for bucket in buckets:
+        messages.extend(m for m in unpack_bucket(bucket) if m.get("seq", 0) > seq)
+        if len(messages) >= limit:
+            break
+    messages.sort(key=lambda m: m.get("seq", 0))
+    return messages[:limit]
+
+async def find_archived_message(conversation_id: str, message_id: str) -> Optional[dict]:
+    bucket = await db.message_buckets.find_one(
+        {"conversation_id": conversation_id, "message_ids": message_id},
+        {"_id": 0, "conversation_id": 1, "data": 1}
+    )
+    if bucket:
+        for msg in unpack_bucket(bucket):
+            if msg["id"] == message_id:
+                return msg
+    return None
+
+class MessageArchiver:
+    # Runs on one worker at a time: the lease in db.meta is renewed by a
+    # heartbeat while a pass runs and released when it ends, so a slow pass
+    # keeps it and a dead worker's lease lapses after LEASE_SECONDS.
+    LEASE_SECONDS = 60.0
+    
+    def __init__(self, after_days: float, bucket_size: int, interval: float):
+        self.after_days = after_days
+        self.bucket_size = bucket_size
+        self.interval = interval
+        self.runs = 0
+        self.buckets_written = 0
+        self.messages_archived = 0
+        self._task = None
+    
+    @property
+    def enabled(self) -> bool:
+        return self.after_days > 0
+    
+    def cutoff(self) -> str:
+        # Whole UTC days only, so a day is archived exactly once
+        moment = datetime.now(timezone.utc) - timedelta(days=self.after_days)
+        return moment.replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
+    
+    async def _acquire(self) -> bool:
+        now = datetime.now(timezone.utc)
+        try:
+            await db.meta.find_one_and_update(
+                {"_id": "archiver", "locked_until": {"$lt": now.isoformat()}},
+                {"$set": {
+                    "owner": WORKER_ID,
+                    "locked_until": (now + timedelta(seconds=self.LEASE_SECONDS)).isoformat()
+                }},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # Another worker holds an unexpired lease
+            return False
+        return True
+    
+    async def _hold(self):
+        while True:
+            await asyncio.sleep(self.LEASE_SECONDS / 3)
+            locked_until = datetime.now(timezone.utc) + timedelta(seconds=self.LEASE_SECONDS)
+            try:
+                await db.meta.update_one(
+                    {"_id": "archiver", "owner": WORKER_ID},
+                    {"$set": {"locked_until": locked_until.isoformat()}}
+                )
+            except Exception:
+                logger.exception("Renewing the archiver lease failed")
+    
+    async def _release(self):
+        await db.meta.update_one({"_id": "archiver", "owner": WORKER_ID}, {"$set": {"locked_until": ""}})
+    
+    async def archive_conversation(self, conv: dict, cutoff: str):
+        start = conv.get("archived_until") or ""
+        query = {"conversation_id": conv["id"], "timestamp": {"$gte": start, "$lt": cutoff}}
+        operations = []
+        day, part, chunk = None, 0, []
+        
+        async def close_chunk():
+            nonlocal part, chunk
+            if chunk:
+                bucket = pack_bucket(conv["id"], day, part, chunk)
+                operations.append(ReplaceOne({"id": bucket["id"]}, bucket, upsert=True))
+                self.messages_archived += len(chunk)
+                part, chunk = part + 1, []
+            if len(operations) >= 20:
+                await db.message_buckets.bulk_write(operations, ordered=False)
+                self.buckets_written += len(operations)
+                operations.clear()
+        
+        async for msg in db.messages.find(query, {"_id": 0}).sort([("timestamp", 1), ("id", 1)]):
+            if msg["timestamp"][:10] != day:
+                await close_chunk()
+                day, part = msg["timestamp"][:10], 0
+            chunk.append(msg)
+            if len(chunk) >= self.bucket_size:
+                await close_chunk()
+        await close_chunk()
+        if operations:
+            await db.message_buckets.bulk_write(operations, ordered=False)
+            self.buckets_written += len(operations)
+        
+        # Buckets first, then the boundary, then the originals: a reader
+        # sees every message exactly once at each step
+        await db.conversations.update_one({"id": conv["id"]}, {"$set": {"archived_until": cutoff}})
+        await db.messages.delete_many(query)
+    
+    async def run_once(self):
+        if not await self._acquire():
+            return
+        heartbeat = asyncio.create_task(self._hold())
+        try:
+            cutoff = self.cutoff()
+            convs = db.conversations.find(
+                {
+                    "created_at": {"$lt": cutoff},
+                    "$or": [{"archived_until": {"$exists": False}}, {"archived_until": {"$lt": cutoff}}]
+                },
+                {"_id": 0, "id": 1, "archived_until": 1}
+            )
+            async for conv in convs:
+                await self.archive_conversation(conv, cutoff)
+            self.runs += 1
+        finally:
+            heartbeat.cancel()
+            await self._release()
+    
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Message archiving failed")
+            await asyncio.sleep(self.interval)
+    
+    def start(self):
+        if self.enabled:
+            self._task = asyncio.create_task(self._run())
+    
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+    
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "after_days": self.after_days,
+            "runs": self.runs,
+            "buckets_written": self.buckets_written,
+            "messages_archived": self.messages_archived
+        }
+
+message_archiver = MessageArchiver(MESSAGE_ARCHIVE_AFTER_DAYS, MESSAGE_BUCKET_SIZE, MESSAGE_ARCHIVE_INTERVAL_SECONDS)
+
+# ===================== UPLOAD ROUTES =====================
+
+def file_type_for(content_type: Optional[str]) -> str:
+    content_type = content_type or ""
     if content_type.startswith("image/"):
-        file_type = "image"
+        return "image"
     elif content_type.startswith("video/"):
-        file_type = "video"
+        return "video"
     elif content_type.startswith("audio/"):
-        file_type = "voice"
+        return "voice"
+    return "file"
+
+async def save_upload(file: UploadFile, file_path: Path) -> tuple:
+    # Copy in fixed-size chunks so memory per upload stays bounded, hashing
+    # as we go so the content can be deduplicated afterwards
+    size = 0
+    digest = hashlib.sha256()
+    try:
+        async with aiofiles.open(file_path, "wb") as f:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail="حجم فایل بیش از حد مجاز است")
+                digest.update(chunk)
+                await f.write(chunk)
+    except BaseException:
+        file_path.unlink(missing_ok=True)
+        raise
+    return size, digest.hexdigest()
+
+def hash_file(file_path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def upload_extension(filename: Optional[str]) -> str:
+    return (Path(filename).suffix if filename else "").lower() or ".bin"
+
+async def store_media(temp_path: Path, digest: str, size: int, filename: Optional[str], content_type: Optional[str]) -> dict:
+    # Identical content is stored once under its hash; the media document
+    # counts how many messages point at the blob.
+    relative_path = f"media/{digest[:2]}/{digest[2:4]}/{digest}{upload_extension(filename)}"
+    update = {
+        "$inc": {"refcount": 1},
+        "$setOnInsert": {
+            "hash": digest,
+            "path": relative_path,
+            "size": size,
+            "content_type": content_type,
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }
+    }
+    try:
+        media = await db.media.find_one_and_update(
+            {"hash": digest}, update, projection={"_id": 0},
+            upsert=True, return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Lost an upsert race with an identical upload; the document exists now
+        media = await db.media.find_one_and_update(
+            {"hash": digest}, {"$inc": {"refcount": 1}}, projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+    
+    blob_path = UPLOAD_DIR / media["path"]
+    if blob_path.exists():
+        temp_path.unlink(missing_ok=True)
     else:
-        file_type = "file"
-    
-    # Save file
-    file_ext = Path(file.filename).suffix if file.filename else ".bin"
-    file_id = str(uuid.uuid4())
-    file_name = f"{file_id}{file_ext}"
-    file_path = UPLOAD_DIR / file_name
-    
-    async with aiofiles.open(file_path, "wb") as f:
-        content = await file.read()
-        await f.write(content)
-    
-    # Create message
-    reply_data = None
-    if reply_to:
-        reply_msg = await db.messages.find_one({"id": reply_to}, {"_id": 0})
-        if reply_msg:
-            reply_data = {
-                "id": reply_msg["id"],
-                "content": reply_msg.get("content"),
-                "sender_name": reply_msg["sender_name"],
-                "type": reply_msg["type"]
-            }
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(temp_path, blob_path)
     
-    msg_id = str(uuid.uuid4())
-    timestamp = datetime.now(timezone.utc).isoformat()
-    file_url = f"/uploads/{file_name}"
+    return media
+
+async def create_file_message(conv: dict, user: dict, filename: Optional[str], content_type: Optional[str],
+                              media: dict, reply_to: Optional[str]) -> dict:
+    reply_data = await get_reply_data(reply_to, conv["id"])
     
     msg_doc = {
-        "id": msg_id,
-        "conversation_id": conversation_id,
-        "sender_id": current_user["id"],
-        "sender_name": current_user["display_name"],
-        "content": file.filename,
-        "type": file_type,
-        "file_url": file_url,
+        "id": str(uuid.uuid4()),
+        "conversation_id": conv["id"],
+        "sender_id": user["id"],
+        "sender_name": user["display_name"],
+        "content": filename,
+        "type": file_type_for(content_type),
+        "file_url": media_url(conv["id"], media["path"]),
         "reply_to": reply_data,
-        "timestamp": timestamp,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
         "status": "sent"
     }
     
-    await db.messages.insert_one(msg_doc)
+    await record_message(conv, msg_doc)
+    await manager.publish({"type": "new_message", "message": msg_doc}, conv["participants"])
+    preview_generator.schedule(conv, msg_doc, media)
+    return msg_doc
+
+# Thumbnails, blur placeholders and video posters are made on a process pool
+# after the message has been delivered; clients get a message_preview event
+# when one is ready. Identical media reuse the preview stored on the media
+# document.
+PREVIEW_WORKERS = int(os.environ.get('PREVIEW_WORKERS', '2'))
+
+class PreviewGenerator:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.generated = 0
+        self.reused = 0
+        self.failed = 0
+        self._executor = None
+        self._tasks = set()
     
-    # Update conversation
-    other_user_id = [p for p in conv["participants"] if p != current_user["id"]][0]
-    await db.conversations.update_one(
-        {"id": conversation_id},
-        {
-            "$set": {"last_message_id": msg_id},
-            "$inc": {f"unread_count.{other_user_id}": 1}
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn keeps workers clear of the event loop and driver threads
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+    
+    def schedule(self, conv: dict, msg_doc: dict, media: dict):
+        if self.workers <= 0 or not previews.available() or msg_doc["type"] not in ("image", "video"):
+            return
+        task = asyncio.create_task(self._attach(conv, msg_doc, media))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _generate(self, media: dict, kind: str) -> Optional[dict]:
+        thumb_path = f"media/previews/{media['hash'][:2]}/{media['hash']}.jpg"
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(
+            self._pool(), previews.generate, kind, str(UPLOAD_DIR / media["path"]), str(UPLOAD_DIR / thumb_path)
+        )
+        if result is None:
+            return None
+        preview = {**result, "thumbnail_path": thumb_path}
+        await db.media.update_one({"hash": media["hash"]}, {"$set": {"preview": preview}})
+        self.generated += 1
+        return preview
+    
+    async def _attach(self, conv: dict, msg_doc: dict, media: dict):
+        try:
+            stored = media.get("preview")
+            if stored:
+                self.reused += 1
+            else:
+                stored = await self._generate(media, msg_doc["type"])
+            if not stored:
+                return
+            
+            # Stored once per blob; the URL is scoped to the conversation
+            preview = {k: v for k, v in stored.items() if k != "thumbnail_path"}
+            preview["thumbnail_url"] = media_url(conv["id"], stored["thumbnail_path"])
+            
+            await db.messages.update_one({"id": msg_doc["id"]}, {"$set": {"preview": preview}})
+            await db.conversations.update_one(
+                {"id": conv["id"], "last_message_id": msg_doc["id"]},
+                {"$set": {"last_message.preview": preview}}
+            )
+            await manager.publish(
+                {
+                    "type": "message_preview",
+                    "conversation_id": conv["id"],
+                    "message_id": msg_doc["id"],
+                    "preview": preview
+                },
+                conv["participants"]
+            )
+        except Exception:
+            self.failed += 1
+            logger.exception("Preview generation failed for %s", media.get("path"))
+    
+    def shutdown(self):
+        for task in self._tasks:
+            task.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+    
+    def stats(self) -> dict:
+        return {
+            "available": previews.available(),
+            "video_posters": bool(previews.FFMPEG),
+            "pending": len(self._tasks),
+            "generated": self.generated,
+            "reused": self.reused,
+            "failed": self.failed
         }
+
+preview_generator = PreviewGenerator(PREVIEW_WORKERS)
+
+# Room for the multipart boundaries and part headers around the file
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+async def parse_upload_form(request: Request, limit: int):
+    # The parser closes the spooled files it has opened only when it sees a
+    # MultiPartException, so a body cut off for size, time or a disconnect is
+    # handed to it as one and the original error re-raised afterwards
+    aborted = None
+    
+    async def body():
+        nonlocal aborted
+        try:
+            async for chunk in upload_stream(request, limit):
+                yield chunk
+        except Exception as e:
+            aborted = e
+            raise MultiPartException("upload aborted")
+    
+    try:
+        return await MultiPartParser(request.headers, body(), max_files=1, max_fields=10).parse()
+    except MultiPartException as e:
+        if aborted is not None:
+            raise aborted
+        raise HTTPException(status_code=400, detail=e.message)
+
+@api_router.post("/upload/{conversation_id}", dependencies=[Depends(upload_slot)])
+async def upload_file(
+    conversation_id: str,
+    request: Request,
+    reply_to: Optional[str] = None,
+    current_user: dict = Depends(limit_uploads)
+):
+    # The body is parsed here rather than by a File() parameter, so the rate
+    # limits, upload slot and membership are checked before any of it is read
+    conv = await get_conversation_for_user(conversation_id, current_user["id"])
+    body_limit = MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES
+    try:
+        declared = int(request.headers.get("content-length", 0))
+    except ValueError:
+        declared = 0
+    if declared > body_limit:
+        raise HTTPException(status_code=413, detail="حجم فایل بیش از حد مجاز است")
+    if not request.headers.get("content-type", "").startswith("multipart/form-data"):
+        raise HTTPException(status_code=400, detail="فایل ارسال نشده است")
+    
+    form = await parse_upload_form(request, body_limit)
+    try:
+        file = form.get("file")
+        if not isinstance(file, StarletteUploadFile):
+            raise HTTPException(status_code=400, detail="فایل ارسال نشده است")
+        
+        # Save file
+        temp_path = UPLOAD_PARTIAL_DIR / str(uuid.uuid4())
+        size, digest = await save_upload(file, temp_path)
+    finally:
+        await form.close()
+    upload_bytes_limiter.charge(current_user["id"], size)
+    media = await store_media(temp_path, digest, size, file.filename, file.content_type)
+    
+    msg_doc = await create_file_message(conv, current_user, file.filename, file.content_type, media, reply_to)
+    return MessageResponse(**msg_doc)
+
+# Resumable uploads: create a session, PUT the bytes in one or more chunks
+# at the offset the server reports, then finalize to post the message.
+
+def upload_session_response(session: dict) -> UploadSessionResponse:
+    return UploadSessionResponse(
+        upload_id=session["id"],
+        offset=session["received"],
+        size=session["size"],
+        chunk_size=UPLOAD_CHUNK_SIZE
+    )
+
+def upload_unlocked() -> dict:
+    return {"$or": [{"lock_until": None}, {"lock_until": {"$lt": datetime.now(timezone.utc).isoformat()}}]}
+
+def upload_live() -> dict:
+    return {"expires_at": {"$gt": datetime.now(timezone.utc).isoformat()}}
+
+async def get_upload_session(upload_id: str, user_id: str) -> dict:
+    session = await db.upload_sessions.find_one({"id": upload_id, "user_id": user_id}, {"_id": 0})
+    if not session:
+        raise HTTPException(status_code=404, detail="آپلود یافت نشد")
+    if session["expires_at"] <= datetime.now(timezone.utc).isoformat():
+        raise HTTPException(status_code=410, detail="مهلت آپلود تمام شده است")
+    return session
+
+@api_router.post("/upload/{conversation_id}/sessions", response_model=UploadSessionResponse)
+async def create_upload_session(
+    conversation_id: str,
+    data: UploadSessionCreate,
+    current_user: dict = Depends(limit_uploads)
+):
+    await get_conversation_for_user(conversation_id, current_user["id"])
+    if data.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="حجم فایل بیش از حد مجاز است")
+    
+    now = datetime.now(timezone.utc)
+    session = {
+        "id": str(uuid.uuid4()),
+        "conversation_id": conversation_id,
+        "user_id": current_user["id"],
+        "filename": data.filename,
+        "content_type": data.content_type,
+        "size": data.size,
+        "received": 0,
+        "reply_to": data.reply_to,
+        "lock_until": None,
+        "created_at": now.isoformat(),
+        "expires_at": (now + timedelta(hours=UPLOAD_SESSION_HOURS)).isoformat()
+    }
+    await db.upload_sessions.insert_one(session)
+    (UPLOAD_PARTIAL_DIR / session["id"]).touch()
+    
+    return upload_session_response(session)
+
+@api_router.get("/upload/sessions/{upload_id}", response_model=UploadSessionResponse)
+async def get_upload_status(upload_id: str, current_user: dict = Depends(get_current_user)):
+    return upload_session_response(await get_upload_session(upload_id, current_user["id"]))
+
+@api_router.put(
+    "/upload/sessions/{upload_id}", response_model=UploadSessionResponse, dependencies=[Depends(upload_slot)]
+)
+async def upload_chunk(
+    upload_id: str,
+    request: Request,
+    offset: int = Query(ge=0),
+    current_user: dict = Depends(limit_upload_chunks)
+):
+    session = await get_upload_session(upload_id, current_user["id"])
+    if offset != session["received"]:
+        raise HTTPException(status_code=409, detail=f"offset باید {session['received']} باشد")
+    try:
+        declared = int(request.headers.get("content-length", 0))
+    except ValueError:
+        declared = 0
+    if offset + declared > session["size"]:
+        raise HTTPException(status_code=413, detail="داده بیش از حجم اعلام‌شده است")
+    
+    # Claim the session so two requests can't write the same range at once.
+    # The lock expires on its own if this worker dies mid-chunk.
+    lock_until = datetime.now(timezone.utc) + timedelta(minutes=5)
+    claimed = await db.upload_sessions.update_one(
+        {"id": upload_id, "received": offset, "$and": [upload_unlocked(), upload_live()]},
+        {"$set": {"lock_until": lock_until.isoformat()}}
+    )
+    if claimed.modified_count == 0:
+        raise HTTPException(status_code=409, detail="آپلود دیگری در حال انجام است")
+    
+    written = 0
+    try:
+        async with aiofiles.open(UPLOAD_PARTIAL_DIR / upload_id, "r+b") as f:
+            # Drop anything past the acknowledged offset left by a dropped chunk
+            await f.truncate(offset)
+            await f.seek(offset)
+            async for chunk in upload_stream(request):
+                if offset + written + len(chunk) > session["size"]:
+                    raise HTTPException(status_code=413, detail="داده بیش از حجم اعلام‌شده است")
+                await f.write(chunk)
+                written += len(chunk)
+    finally:
+        upload_bytes_limiter.charge(current_user["id"], written)
+        # Whatever reached the disk counts, so a dropped connection resumes here
+        await db.upload_sessions.update_one(
+            {"id": upload_id},
+            {"$set": {"received": offset + written, "lock_until": None}}
+        )
+    
+    session["received"] = offset + written
+    return upload_session_response(session)
+
+@api_router.post(
+    "/upload/sessions/{upload_id}/finalize", response_model=MessageResponse, dependencies=[Depends(upload_slot)]
+)
+async def finalize_upload(upload_id: str, current_user: dict = Depends(get_current_user)):
+    session = await get_upload_session(upload_id, current_user["id"])
+    if session["received"] != session["size"]:
+        raise HTTPException(status_code=409, detail=f"offset باید {session['size']} باشد")
+    conv = await get_conversation_for_user(session["conversation_id"], current_user["id"])
+    
+    # Claim the session for the hash and the move into media storage; it is
+    # only deleted once the file has left .partial, so a failed finalize can
+    # be retried and an abandoned one is still reached by the cleanup
+    lock_until = datetime.now(timezone.utc) + timedelta(minutes=5)
+    claimed = await db.upload_sessions.update_one(
+        {"id": upload_id, "$and": [upload_unlocked(), upload_live()]},
+        {"$set": {"lock_until": lock_until.isoformat()}}
     )
+    if claimed.modified_count == 0:
+        raise HTTPException(status_code=409, detail="آپلود دیگری در حال انجام است")
     
+    temp_path = UPLOAD_PARTIAL_DIR / upload_id
+    try:
+        digest = await asyncio.to_thread(hash_file, temp_path)
+        media = await store_media(temp_path, digest, session["size"], session["filename"], session["content_type"])
+    except Exception:
+        await db.upload_sessions.update_one({"id": upload_id}, {"$set": {"lock_until": None}})
+        raise
+    await db.upload_sessions.delete_one({"id": upload_id})
+    
+    msg_doc = await create_file_message(
+        conv, current_user, session["filename"], session["content_type"], media, session.get("reply_to")
+    )
     return MessageResponse(**msg_doc)
 
+@api_router.delete("/upload/sessions/{upload_id}")
+async def cancel_upload(upload_id: str, current_user: dict = Depends(get_current_user)):
+    await get_upload_session(upload_id, current_user["id"])
+    await db.upload_sessions.delete_one({"id": upload_id})
+    (UPLOAD_PARTIAL_DIR / upload_id).unlink(missing_ok=True)
+    return {"message": "آپلود لغو شد"}
+
+def stale_partial_files(cutoff: float) -> List[Path]:
+    return [path for path in UPLOAD_PARTIAL_DIR.iterdir() if path.is_file() and path.stat().st_mtime < cutoff]
+
+class UploadCleaner:
+    # Every worker runs this; deletes are idempotent. Expired sessions go
+    # first, then any .partial file older than a session can live that no
+    # session points at (single-request uploads cut off mid-body, crashes).
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.runs = 0
+        self.sessions_removed = 0
+        self.files_removed = 0
+        self._task = None
+    
+    async def run_once(self):
+        now = datetime.now(timezone.utc)
+        expired = db.upload_sessions.find(
+            {"expires_at": {"$lt": now.isoformat()}, **upload_unlocked()}, {"_id": 0, "id": 1}
+        )
+        async for session in expired:
+            deleted = await db.upload_sessions.delete_one({"id": session["id"], **upload_unlocked()})
+            if deleted.deleted_count:
+                (UPLOAD_PARTIAL_DIR / session["id"]).unlink(missing_ok=True)
+                self.sessions_removed += 1
+        
+        cutoff = (now - timedelta(hours=UPLOAD_SESSION_HOURS)).timestamp()
+        candidates = await asyncio.to_thread(stale_partial_files, cutoff)
+        if candidates:
+            live = await db.upload_sessions.find(
+                {"id": {"$in": [path.name for path in candidates]}}, {"_id": 0, "id": 1}
+            ).to_list(None)
+            live_ids = {session["id"] for session in live}
+            for path in candidates:
+                if path.name not in live_ids:
+                    path.unlink(missing_ok=True)
+                    self.files_removed += 1
+        self.runs += 1
+    
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Upload cleanup failed")
+            await asyncio.sleep(self.interval)
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+    
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "sessions_removed": self.sessions_removed,
+            "files_removed": self.files_removed
+        }
+
+upload_cleaner = UploadCleaner(UPLOAD_CLEANUP_INTERVAL_SECONDS)
+
+# ===================== MEDIA =====================
+
+# Uploaded files are only served through this route: the caller must belong
+# to the conversation and a message in it must reference the file. Browsers
+# load media through <img>/<video> tags that can't send headers, so those use
+# ?token= with a short-lived token signed for that one file (POST
+# /api/media/token); the login token is only accepted as a header. Files are
+# served sandboxed, and anything but plain raster images, video and audio is
+# sent as a download so uploaded HTML or SVG never runs at the API origin.
+MEDIA_CACHE_CONTROL = "private, max-age=31536000, immutable"
+MEDIA_ACCESS_CACHE_SIZE = int(os.environ.get('MEDIA_ACCESS_CACHE_SIZE', '50000'))
+MEDIA_TOKEN_SECONDS = int(os.environ.get('MEDIA_TOKEN_SECONDS', '600'))
+INLINE_MEDIA_TYPES = {
+    "image/jpeg", "image/png", "image/gif", "image/webp", "image/avif", "image/bmp",
+    "video/mp4", "video/webm", "video/ogg", "video/quicktime",
+    "audio/mpeg", "audio/ogg", "audio/webm", "audio/wav", "audio/x-wav", "audio/mp4", "audio/aac"
+}
+
+media_access_cache = TTLCache(MEDIA_ACCESS_CACHE_SIZE, CACHE_TTL_SECONDS)
+
+def media_url(conversation_id: str, path: str) -> str:
+    return f"/api/media/{conversation_id}/{path}"
+
+async def media_referenced(conversation_id: str, path: str) -> bool:
+    key = (conversation_id, path)
+    if media_access_cache.get(key):
+        return True
+    url = media_url(conversation_id, path)
+    found = await db.messages.find_one(
+        {"conversation_id": conversation_id, "$or": [{"file_url": url}, {"preview.thumbnail_url": url}]},
+        {"_id": 1}
+    )
+    if not found:
+        found = await db.message_buckets.find_one({"conversation_id": conversation_id, "file_urls": url}, {"_id": 1})
+    if found:
+        media_access_cache.set(key, True)
+    return found is not None
+
+MEDIA_URL_PATTERN = re.compile(r"^/api/media/([^/]+)/(.+)$")
+
+def create_media_token(user_id: str, url: str) -> tuple:
+    # Expiry is rounded up to a window boundary so the signed URL stays the
+    # same, and cacheable by the browser, for a whole window; it is valid for
+    # at least MEDIA_TOKEN_SECONDS
+    expires = (int(time.time()) // MEDIA_TOKEN_SECONDS + 2) * MEDIA_TOKEN_SECONDS
+    token = jwt.encode({"sub": user_id, "scope": "media", "path": url, "exp": expires}, SECRET_KEY, algorithm=ALGORITHM)
+    return token, expires
+
+def media_token_user(token: str, url: str) -> str:
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if payload.get("scope") != "media" or payload.get("path") != url or not payload.get("sub"):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return payload["sub"]
+
+async def media_file(conversation_id: str, path: str, user_id: str) -> Path:
+    await get_conversation_for_user(conversation_id, user_id)
+    root = UPLOAD_DIR.resolve()
+    file_path = (UPLOAD_DIR / path).resolve()
+    if root not in file_path.parents or UPLOAD_PARTIAL_DIR.resolve() in file_path.parents:
+        raise HTTPException(status_code=404, detail="فایل یافت نشد")
+    if not await media_referenced(conversation_id, path):
+        raise HTTPException(status_code=404, detail="فایل یافت نشد")
+    return file_path
+
+CONTENT_ADDRESSED_PATH = re.compile(r"^media/[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64})\.[^/]+$")
+
+def media_etag(relative_path: str, stat: os.stat_result) -> str:
+    # Blobs are named by their sha256; thumbnails and older uploads are never
+    # rewritten either, so all of them get strong validators
+    match = CONTENT_ADDRESSED_PATH.match(relative_path)
+    if match:
+        return f'"{match.group(1)}"'
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+def parse_range(header: str, size: int) -> Optional[tuple]:
+    # Single byte ranges only; anything else is answered with the whole file
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            start = max(size - int(last), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        raise HTTPException(
+            status_code=416, detail="محدوده درخواستی نامعتبر است",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+def etag_matches(header: str, etag: str) -> bool:
+    candidates = [c.strip() for c in header.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+class MediaFileResponse(Response):
+    # Streams a byte range of a file. Servers advertising the ASGI zero-copy
+    # or pathsend extensions hand the transfer to the kernel; otherwise the
+    # file is read in UPLOAD_CHUNK_SIZE pieces.
+    def __init__(self, path: Path, start: int, end: int, status_code: int, headers: dict, send_body: bool):
+        super().__init__(status_code=status_code, headers=headers)
+        self.path = path
+        self.start = start
+        self.length = end - start + 1
+        self.send_body = send_body
+    
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if not self.send_body or self.length <= 0:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        
+        extensions = scope.get("extensions") or {}
+        if "http.response.zerocopysend" in extensions:
+            with open(self.path, "rb") as f:
+                await send({"type": "http.response.zerocopysend", "file": f, "offset": self.start, "count": self.length})
+            return
+        if "http.response.pathsend" in extensions and self.start == 0 and self.length == self.path.stat().st_size:
+            await send({"type": "http.response.pathsend", "path": str(self.path)})
+            return
+        
+        remaining = self.length
+        async with aiofiles.open(self.path, "rb") as f:
+            await f.seek(self.start)
+            while remaining > 0:
+                chunk = await f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+        if remaining > 0:
+            # File shrank underneath us; end the response rather than hang
+            await send({"type": "http.response.body", "body": b""})
+
+# Links from before the /api/media move (browser caches, copied links, a
+# frontend build still being served) used to hit the public /uploads mount.
+# For one release they keep resolving: a caller with a login token is sent
+# to the file's place in one of their conversations, anything else gets 410.
+@app.api_route("/uploads/{path:path}", methods=["GET", "HEAD"], include_in_schema=False)
+async def legacy_upload(path: str, credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)):
+    if credentials:
+        user = await user_from_token(credentials.credentials)
+        conversation_ids = await db.conversations.find(
+            {"participants": user["id"]}, {"_id": 0, "id": 1}
+        ).to_list(None)
+        pattern = f"^/api/media/[^/]+/{re.escape(path)}$"
+        msg = await db.messages.find_one(
+            {
+                "conversation_id": {"$in": [c["id"] for c in conversation_ids]},
+                "$or": [{"file_url": {"$regex": pattern}}, {"preview.thumbnail_url": {"$regex": pattern}}]
+            },
+            {"_id": 0, "conversation_id": 1}
+        )
+        if msg:
+            return RedirectResponse(media_url(msg["conversation_id"], path), status_code=307)
+    raise HTTPException(status_code=410, detail="این لینک قدیمی است؛ صفحه را دوباره بارگذاری کنید")
+
+@api_router.post("/media/token", response_model=MediaTokenResponse)
+async def create_media_url(data: MediaTokenRequest, current_user: dict = Depends(get_current_user)):
+    match = MEDIA_URL_PATTERN.match(data.url)
+    if not match:
+        raise HTTPException(status_code=404, detail="فایل یافت نشد")
+    await media_file(match.group(1), match.group(2), current_user["id"])
+    token, expires = create_media_token(current_user["id"], data.url)
+    return MediaTokenResponse(
+        url=f"{data.url}?token={token}",
+        expires_at=datetime.fromtimestamp(expires, timezone.utc).isoformat()
+    )
+
+@api_router.api_route("/media/{conversation_id}/{path:path}", methods=["GET", "HEAD"])
+async def get_media(
+    conversation_id: str,
+    path: str,
+    request: Request,
+    token: Optional[str] = Query(None),
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+):
+    if credentials:
+        user_id = (await user_from_token(credentials.credentials))["id"]
+    elif token:
+        user_id = media_token_user(token, media_url(conversation_id, path))
+    else:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    file_path = await media_file(conversation_id, path, user_id)
+    try:
+        stat = file_path.stat()
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="فایل یافت نشد")
+    
+    size = stat.st_size
+    etag = media_etag(file_path.relative_to(UPLOAD_DIR.resolve()).as_posix(), stat)
+    last_modified = datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+    content_type = mimetypes.guess_type(file_path.name)[0] or "application/octet-stream"
+    headers = {
+        "ETag": etag,
+        "Last-Modified": last_modified.strftime("%a, %d %b %Y %H:%M:%S GMT"),
+        "Cache-Control": MEDIA_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+        "Content-Type": content_type,
+        "X-Content-Type-Options": "nosniff",
+        "Content-Security-Policy": "sandbox"
+    }
+    if content_type not in INLINE_MEDIA_TYPES:
+        headers["Content-Disposition"] = "attachment"
+    
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        not_modified = etag_matches(if_none_match, etag)
+    else:
+        not_modified = False
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                not_modified = last_modified.replace(microsecond=0) <= parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                pass
+    if not_modified:
+        headers.pop("Content-Type")
+        return Response(status_code=304, headers=headers)
+    
+    byte_range = None
+    range_header = request.headers.get("range")
+    if range_header:
+        # A stale If-Range means the client's partial copy is useless
+        if_range = request.headers.get("if-range")
+        if not if_range or if_range.strip() == etag:
+            byte_range = parse_range(range_header, size)
+    
+    if byte_range:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    else:
+        start, end = 0, size - 1
+        status_code = 200
+    headers["Content-Length"] = str(end - start + 1)
+    
+    return MediaFileResponse(file_path, start, end, status_code, headers, send_body=request.method != "HEAD")
+
 # ===================== WEBSOCKET =====================
 
-class ConnectionManager:
+# Pub/sub backend used to fan websocket events out to every worker.
+# "local" delivers in-process only (single worker); "unix" exchanges
+# datagrams between all workers on the host through BROKER_SOCKET_DIR.
+BROKER = os.environ.get('BROKER', 'local')
+BROKER_SOCKET_DIR = Path(os.environ.get('BROKER_SOCKET_DIR', '/tmp/picochat-broker'))
+BROKER_MAX_DATAGRAM = 1024 * 1024
+
+class LocalBroker:
     def __init__(self):
-        self.active_connections: dict[str, WebSocket] = {}
+        self._deliver = None
     
-    async def connect(self, websocket: WebSocket, user_id: str):
-        await websocket.accept()
-        self.active_connections[user_id] = websocket
-        await db.users.update_one({"id": user_id}, {"$set": {"is_online": True}})
+    async def start(self, deliver):
+        self._deliver = deliver
     
-    def disconnect(self, user_id: str):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
+    async def publish(self, user_ids: List[str], message: dict):
+        await self._deliver(user_ids, message)
     
-    async def send_personal_message(self, message: dict, user_id: str):
-        if user_id in self.active_connections:
+    async def stop(self):
+        pass
+
+class UnixSocketBroker:
+    # Every worker binds a datagram socket in a shared directory and sends
+    # each event to all the other sockets it finds there. Sockets left behind
+    # by dead workers refuse the datagram and are removed.
+    PEER_REFRESH_SECONDS = 1.0
+    
+    def __init__(self, socket_dir: Path):
+        self.socket_dir = socket_dir
+        self.path = socket_dir / f"{os.getpid()}-{uuid.uuid4().hex[:8]}.sock"
+        self._sock = None
+        self._reader = None
+        self._deliver = None
+        self._peers = []
+        self._peers_checked_at = 0.0
+    
+    async def start(self, deliver):
+        self._deliver = deliver
+        self.socket_dir.mkdir(parents=True, exist_ok=True)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, BROKER_MAX_DATAGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, BROKER_MAX_DATAGRAM)
+        self._sock.setblocking(False)
+        self._sock.bind(str(self.path))
+        self._reader = asyncio.create_task(self._read_loop())
+    
+    def _current_peers(self) -> List[Path]:
+        now = time.monotonic()
+        if now - self._peers_checked_at > self.PEER_REFRESH_SECONDS:
+            self._peers = [p for p in self.socket_dir.glob("*.sock") if p != self.path]
+            self._peers_checked_at = now
+        return self._peers
+    
+    async def _read_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            data, _ = await loop.sock_recvfrom(self._sock, BROKER_MAX_DATAGRAM)
             try:
-                await self.active_connections[user_id].send_json(message)
-            except:
-                pass
+                envelope = json.loads(data)
+                await self._deliver(envelope["users"], envelope["message"])
+            except (ValueError, KeyError):
+                logger.warning("Dropping malformed broker datagram")
+            except Exception:
+                logger.exception("Broker delivery failed")
+    
+    async def publish(self, user_ids: List[str], message: dict):
+        await self._deliver(user_ids, message)
+        
+        data = json.dumps({"users": user_ids, "message": message}).encode()
+        loop = asyncio.get_running_loop()
+        for peer in self._current_peers():
+            try:
+                await loop.sock_sendto(self._sock, data, str(peer))
+            except (ConnectionRefusedError, FileNotFoundError):
+                peer.unlink(missing_ok=True)
+                self._peers_checked_at = 0.0
+            except OSError as e:
+                logger.warning("Broker send to %s failed: %s", peer.name, e)
+    
+    async def stop(self):
+        if self._reader:
+            self._reader.cancel()
+        if self._sock:
+            self._sock.close()
+        self.path.unlink(missing_ok=True)
+
+def create_broker():
+    if BROKER == "unix":
+        return UnixSocketBroker(BROKER_SOCKET_DIR)
+    if BROKER != "local":
+        raise RuntimeError(f"Unknown BROKER backend: {BROKER}")
+    return LocalBroker()
+
+# Outbound events are buffered per connection; when a client can't keep up
+# the policy decides what happens: "drop" discards the new event,
+# "coalesce" replaces stale typing/read events and disconnects if that
+# isn't enough, "disconnect" closes the socket so the client resyncs.
+WS_SEND_QUEUE_SIZE = int(os.environ.get('WS_SEND_QUEUE_SIZE', '256'))
+WS_SLOW_CONSUMER_POLICY = os.environ.get('WS_SLOW_CONSUMER_POLICY', 'coalesce')
+
+# Clients pick the wire format with the websocket subprotocol. Without one
+# every frame is a single JSON object, as before. With "picochat.msgpack"
+# client frames are MessagePack maps and server frames are MessagePack
+# arrays carrying up to WS_BATCH_MAX queued events. permessage-deflate is
+# negotiated by uvicorn on top of either.
+WS_MSGPACK_PROTOCOL = "picochat.msgpack"
+WS_BATCH_MAX = int(os.environ.get('WS_BATCH_MAX', '32'))
+
+class OutboundEvent:
+    # Encoded at most once per format, however many connections it reaches
+    __slots__ = ("message", "_text", "_packed")
+    
+    def __init__(self, message: dict):
+        self.message = message
+        self._text = None
+        self._packed = None
+    
+    @property
+    def type(self) -> str:
+        return self.message.get("type", "")
+    
+    def text(self) -> str:
+        if self._text is None:
+            self._text = json.dumps(self.message, separators=(",", ":"), ensure_ascii=False)
+        return self._text
+    
+    def packed(self) -> bytes:
+        if self._packed is None:
+            self._packed = msgpack.packb(self.message)
+        return self._packed
+
+def msgpack_array(items: List[bytes]) -> bytes:
+    # Joins already-packed events into one array frame without re-encoding them
+    count = len(items)
+    if count < 16:
+        header = bytes([0x90 | count])
+    elif count < 0x10000:
+        header = b"\xdc" + count.to_bytes(2, "big")
+    else:
+        header = b"\xdd" + count.to_bytes(4, "big")
+    return header + b"".join(items)
+
+def coalesce_key(message: dict) -> Optional[tuple]:
+    if message.get("type") == "error":
+        return ("error", message.get("code"), message.get("frame_type"))
+    if message.get("type") == "typing":
+        return ("typing", message.get("conversation_id"), message.get("user_id"))
+    if message.get("type") == "messages_read":
+        return ("messages_read", message.get("conversation_id"), message.get("user_id"))
+    return None
+
+class ClientConnection:
+    def __init__(self, websocket: WebSocket, user_id: str, binary: bool = False):
+        self.id = str(uuid.uuid4())
+        self.websocket = websocket
+        self.user_id = user_id
+        self.binary = binary
+        self.frames = TokenBucket(*WS_CONNECTION_FRAME_RATE)
+        self.closing = False
+        self._pending = deque()
+        self._wakeup = asyncio.Event()
+        self._writer = None
+    
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
+    
+    def start(self):
+        self._writer = asyncio.create_task(self._write_loop())
+    
+    def stop(self):
+        self.closing = True
+        self._pending.clear()
+        if self._writer:
+            self._writer.cancel()
+    
+    async def _write_loop(self):
+        try:
+            while True:
+                while not self._pending:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                if self.binary:
+                    events = [self._pending.popleft() for _ in range(min(WS_BATCH_MAX, len(self._pending)))]
+                    await self.websocket.send_bytes(msgpack_array([event.packed() for event in events]))
+                else:
+                    events = [self._pending.popleft()]
+                    await self.websocket.send_text(events[0].text())
+                for event in events:
+                    ws_events_sent.inc(event.type)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # The receive loop notices the dead socket and cleans up
+            logger.info("Websocket writer for %s stopped: %s", self.user_id, e)
+            self.closing = True
+    
+    def enqueue(self, message) -> bool:
+        if self.closing:
+            return False
+        event = message if isinstance(message, OutboundEvent) else OutboundEvent(message)
+        if len(self._pending) >= WS_SEND_QUEUE_SIZE and not self._make_room(event.message):
+            return False
+        self._pending.append(event)
+        self._wakeup.set()
+        return True
+    
+    async def receive(self) -> dict:
+        message = await self.websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        if message.get("bytes") is not None:
+            if msgpack is None:
+                raise ValueError("Binary frames are not supported")
+            data = msgpack.unpackb(message["bytes"])
+        else:
+            data = json.loads(message["text"])
+        if not isinstance(data, dict):
+            raise ValueError("Websocket frames must be objects")
+        return data
+    
+    def _make_room(self, message: dict) -> bool:
+        if WS_SLOW_CONSUMER_POLICY == "drop":
+            ws_events_dropped.inc()
+            return False
+        
+        if WS_SLOW_CONSUMER_POLICY == "coalesce":
+            key = coalesce_key(message)
+            if key is not None:
+                # Newer typing/read events supersede queued ones
+                kept = [e for e in self._pending if coalesce_key(e.message) != key]
+                if len(kept) < len(self._pending):
+                    ws_events_dropped.inc(value=len(self._pending) - len(kept))
+                    self._pending = deque(kept)
+                    return True
+                ws_events_dropped.inc()
+                return False
+            ephemeral = [i for i, e in enumerate(self._pending) if coalesce_key(e.message) is not None]
+            if ephemeral:
+                del self._pending[ephemeral[0]]
+                ws_events_dropped.inc()
+                return True
+        
+        logger.warning("Disconnecting slow websocket client %s (%d events queued)", self.user_id, len(self._pending))
+        self.stop()
+        self._writer = asyncio.create_task(self.websocket.close(code=1013))
+        return False
+
+class ConnectionManager:
+    def __init__(self, broker):
+        # user_id -> connection id -> connection; a user may have several tabs/devices
+        self.active_connections: dict[str, dict[str, ClientConnection]] = {}
+        self.broker = broker
+        self.slow_disconnects = 0
+    
+    async def connect(self, websocket: WebSocket, user_id: str) -> ClientConnection:
+        binary = msgpack is not None and WS_MSGPACK_PROTOCOL in websocket.scope.get("subprotocols", [])
+        await websocket.accept(subprotocol=WS_MSGPACK_PROTOCOL if binary else None)
+        connection = ClientConnection(websocket, user_id, binary)
+        connection.start()
+        self.active_connections.setdefault(user_id, {})[connection.id] = connection
+        return connection
+    
+    def disconnect(self, connection: ClientConnection) -> bool:
+        # Returns True when this was the user's last connection
+        connection.stop()
+        connections = self.active_connections.get(connection.user_id, {})
+        connections.pop(connection.id, None)
+        if connections:
+            return False
+        self.active_connections.pop(connection.user_id, None)
+        return True
+    
+    def send_personal_message(self, message, user_id: str):
+        for connection in list(self.active_connections.get(user_id, {}).values()):
+            was_closing = connection.closing
+            if not connection.enqueue(message) and connection.closing and not was_closing:
+                self.slow_disconnects += 1
+    
+    async def deliver_local(self, user_ids: List[str], message: dict):
+        if message.get("type") in ("presence", "presence_sync", "presence_release"):
+            presence.observe(message)
+        elif message.get("type") == "conversation_updated":
+            conversation_cache.invalidate(message["conversation_id"])
+            for user_id in user_ids:
+                contacts_cache.invalidate(user_id)
+        # Shared by every recipient so each format is encoded once; enqueueing
+        # never waits on a socket, so a large group is one pass over its members
+        event = OutboundEvent(message)
+        for user_id in user_ids:
+            self.send_personal_message(event, user_id)
+    
+    async def publish(self, message: dict, user_ids: List[str]):
+        # Reaches the users wherever they are connected, on any worker
+        await self.broker.publish(user_ids, message)
+    
+    def stats(self) -> dict:
+        connections = [c for conns in self.active_connections.values() for c in conns.values()]
+        depths = [c.queue_depth for c in connections]
+        return {
+            "users": len(self.active_connections),
+            "connections": len(connections),
+            "binary_connections": sum(1 for c in connections if c.binary),
+            "queued_events": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "queue_limit": WS_SEND_QUEUE_SIZE,
+            "slow_consumer_policy": WS_SLOW_CONSUMER_POLICY,
+            "dropped_events": ws_events_dropped.value(),
+            "slow_disconnects": self.slow_disconnects
+        }
+
+manager = ConnectionManager(create_broker())
+
+# ===================== PRESENCE =====================
+
+# Online state is kept in memory from live websockets (uvicorn's ping/pong
+# detects dead peers) and written to Mongo in one batch per flush interval.
+# Users connected to this worker get last_seen refreshed on every flush, so
+# if a worker dies its users read as offline once PRESENCE_TIMEOUT_SECONDS
+# pass without a refresh.
+#
+# Every worker tracks which other workers hold which users. Contacts are only
+# told a user went offline once no worker holds them: a worker losing its last
+# socket for a user still held elsewhere just tells the other workers
+# ("presence_release"), and a worker that sees an offline announcement for a
+# user it still holds announces them online again.
+PRESENCE_FLUSH_SECONDS = float(os.environ.get('PRESENCE_FLUSH_SECONDS', '15'))
+PRESENCE_TIMEOUT_SECONDS = float(os.environ.get('PRESENCE_TIMEOUT_SECONDS', str(PRESENCE_FLUSH_SECONDS * 3)))
+WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+contacts_cache = TTLCache(USER_CACHE_SIZE, CACHE_TTL_SECONDS)
 
-manager = ConnectionManager()
+async def get_contacts(user_id: str) -> List[str]:
+    contacts = contacts_cache.get(user_id)
+    if contacts is None:
+        participants = await db.conversations.distinct("participants", {"participants": user_id})
+        contacts = [p for p in participants if p != user_id]
+        contacts_cache.set(user_id, contacts)
+    return contacts
+
+class PresenceService:
+    def __init__(self, flush_interval: float, timeout: float):
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.flushes = 0
+        self.writes = 0
+        self._local = {}      # user_id -> last activity, users with a socket here
+        self._remote = {}     # user_id -> {worker id: expiry (monotonic)}, online on other workers
+        self._last_seen = {}  # user_id -> last_seen of users who went offline
+        self._offline = set() # went offline since the last flush
+        self._deferred = set() # left this worker while held elsewhere; offline not announced yet
+        self._announcing = set()
+        self._task = None
+    
+    def held_elsewhere(self, user_id: str) -> bool:
+        now = time.monotonic()
+        return any(expiry > now for expiry in self._remote.get(user_id, {}).values())
+    
+    def is_online(self, user_id: str) -> bool:
+        return user_id in self._local or self.held_elsewhere(user_id)
+    
+    def is_online_from_doc(self, user: dict) -> bool:
+        # Falls back to the flushed state, trusting it only while it's fresh
+        if self.is_online(user["id"]):
+            return True
+        cutoff = (datetime.now(timezone.utc) - timedelta(seconds=self.timeout)).isoformat()
+        return bool(user.get("is_online")) and (user.get("last_seen") or "") >= cutoff
+    
+    def last_seen(self, user_id: str) -> Optional[str]:
+        return self._local.get(user_id) or self._last_seen.get(user_id)
+    
+    def touch(self, user_id: str):
+        if user_id in self._local:
+            self._local[user_id] = datetime.now(timezone.utc).isoformat()
+    
+    async def connected(self, user_id: str):
+        was_online = self.is_online(user_id)
+        self._local[user_id] = datetime.now(timezone.utc).isoformat()
+        self._offline.discard(user_id)
+        self._deferred.discard(user_id)
+        if not was_online:
+            await self._announce(user_id, True)
+        else:
+            # Contacts already see them online; the other workers learn we hold them too
+            await manager.publish({"type": "presence_sync", "worker": WORKER_ID, "online": [user_id]}, [])
+    
+    async def disconnected(self, user_id: str):
+        self._last_seen[user_id] = datetime.now(timezone.utc).isoformat()
+        self._local.pop(user_id, None)
+        self._offline.add(user_id)
+        if self.held_elsewhere(user_id):
+            self._deferred.add(user_id)
+            await manager.publish(
+                {"type": "presence_release", "worker": WORKER_ID, "user_id": user_id, "last_seen": self.last_seen(user_id)},
+                []
+            )
+        else:
+            await self._announce(user_id, False)
+    
+    def logged_out(self, user_id: str):
+        if user_id not in self._local:
+            self._last_seen[user_id] = datetime.now(timezone.utc).isoformat()
+            self._offline.add(user_id)
+    
+    async def _announce(self, user_id: str, online: bool):
+        # Only people who share a conversation with the user hear about it
+        contacts = await get_contacts(user_id)
+        await manager.publish(
+            {
+                "type": "presence", "user_id": user_id, "is_online": online,
+                "last_seen": self.last_seen(user_id), "worker": WORKER_ID
+            },
+            contacts
+        )
+    
+    def _announce_later(self, user_id: str, online: bool):
+        # observe() runs inside event delivery, which must not wait on a publish
+        if user_id in self._announcing:
+            return
+        self._announcing.add(user_id)
+        
+        async def announce():
+            try:
+                await self._announce(user_id, online)
+            except Exception:
+                logger.exception("Presence announcement for %s failed", user_id)
+            finally:
+                self._announcing.discard(user_id)
+        asyncio.get_running_loop().create_task(announce())
+    
+    def observe(self, message: dict):
+        # Presence events from every worker arrive here through the broker
+        worker = message.get("worker")
+        if worker == WORKER_ID:
+            return
+        expiry = time.monotonic() + self.timeout
+        if message["type"] == "presence_sync":
+            for user_id in message["online"]:
+                self._remote.setdefault(user_id, {})[worker] = expiry
+            return
+        user_id = message["user_id"]
+        if message["type"] == "presence" and message["is_online"]:
+            self._remote.setdefault(user_id, {})[worker] = expiry
+            self._deferred.discard(user_id)
+            return
+        
+        holders = self._remote.get(user_id, {})
+        holders.pop(worker, None)
+        if not holders:
+            self._remote.pop(user_id, None)
+        if user_id not in self._local and message.get("last_seen"):
+            self._last_seen[user_id] = message["last_seen"]
+        if user_id in self._local:
+            if message["type"] == "presence":
+                # Contacts were told they left, but they still have a socket here
+                self._announce_later(user_id, True)
+        elif user_id in self._deferred and not self.held_elsewhere(user_id):
+            # The worker we deferred to let go at the same time
+            self._deferred.discard(user_id)
+            self._announce_later(user_id, False)
+    
+    async def flush(self):
+        now = datetime.now(timezone.utc).isoformat()
+        operations = []
+        online = list(self._local)
+        if online:
+            operations.append(UpdateMany({"id": {"$in": online}}, {"$set": {"is_online": True, "last_seen": now}}))
+        offline, self._offline = self._offline, set()
+        for user_id in offline:
+            if not self.is_online(user_id):
+                operations.append(UpdateOne(
+                    {"id": user_id},
+                    {"$set": {"is_online": False, "last_seen": self._last_seen.get(user_id, now)}}
+                ))
+        if operations:
+            await db.users.bulk_write(operations, ordered=False)
+            self.writes += len(operations)
+        self.flushes += 1
+        
+        # Tell the other workers who is still here and drop expired entries
+        if online:
+            await manager.publish({"type": "presence_sync", "worker": WORKER_ID, "online": online}, [])
+        current = time.monotonic()
+        remote = {}
+        for user_id, holders in self._remote.items():
+            holders = {w: expiry for w, expiry in holders.items() if expiry > current}
+            if holders:
+                remote[user_id] = holders
+        self._remote = remote
+        
+        # Deferred to a worker that has since gone quiet (it died, or its
+        # release never arrived)
+        for user_id in [u for u in self._deferred if not self.is_online(u)]:
+            self._deferred.discard(user_id)
+            await self._announce(user_id, False)
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Presence flush failed")
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        await self.flush()
+    
+    def stats(self) -> dict:
+        return {
+            "local_online": len(self._local),
+            "remote_online": len(self._remote),
+            "pending_offline": len(self._offline),
+            "deferred_offline": len(self._deferred),
+            "flushes": self.flushes,
+            "writes": self.writes
+        }
+
+presence = PresenceService(PRESENCE_FLUSH_SECONDS, PRESENCE_TIMEOUT_SECONDS)
+
+# ===================== RUNTIME STATS =====================
+
+class LoopLagMonitor:
+    # Measures how late a periodic sleep wakes up; anything that blocks the
+    # event loop (bcrypt used to) shows up here as lag.
+    def __init__(self, interval: float = 0.25, stall_threshold: float = 0.1):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.samples = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._task = None
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - started - self.interval)
+            event_loop_lag.observe(lag)
+            self.samples += 1
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.stall_threshold:
+                self.stalls += 1
+    
+    def stats(self) -> dict:
+        return {
+            "samples": self.samples,
+            "avg_lag_ms": round(self.total_lag / self.samples * 1000, 2) if self.samples else 0.0,
+            "max_lag_ms": round(self.max_lag * 1000, 2),
+            "stalls": self.stalls
+        }
+
+loop_monitor = LoopLagMonitor()
+
+# Operational endpoints (/stats, /metrics) live outside /api, so the nginx
+# config never proxies them, and only answer clients on INTERNAL_NETWORKS for
+# setups like docker-compose that publish the backend port directly
+INTERNAL_NETWORKS = [
+    ipaddress.ip_network(net.strip()) for net in os.environ.get(
+        'INTERNAL_NETWORKS', '127.0.0.0/8,::1/128,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16'
+    ).split(',') if net.strip()
+]
+
+async def require_internal(request: Request):
+    try:
+        address = ipaddress.ip_address(request.client.host if request.client else "")
+    except ValueError:
+        address = None
+    if address is None or not any(address in net for net in INTERNAL_NETWORKS):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+@app.get("/stats", include_in_schema=False, dependencies=[Depends(require_internal)])
+async def runtime_stats():
+    return {
+        "websocket": manager.stats(),
+        "user_cache": user_cache.stats(),
+        "conversation_cache": conversation_cache.stats(),
+        "password_hashing": password_hasher.stats(),
+        "message_batching": message_batcher.stats(),
+        "presence": presence.stats(),
+        "previews": preview_generator.stats(),
+        "archive": message_archiver.stats(),
+        "upload_cleanup": upload_cleaner.stats(),
+        "rate_limits": rate_limit_stats(),
+        "event_loop": loop_monitor.stats()
+    }
+
+WS_FRAME_TYPES = ("ping", "message", "typing", "read", "sync")
+# Frames that take a slot under EXPENSIVE_CONCURRENCY while being handled
+WS_EXPENSIVE_FRAMES = ("message", "sync")
 
 @app.websocket("/ws/{token}")
 async def websocket_endpoint(websocket: WebSocket, token: str):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id = payload.get("sub")
-        if not user_id:
+        if not user_id or "scope" in payload:
             await websocket.close(code=4001)
             return
     except JWTError:
         await websocket.close(code=4001)
         return
     
-    await manager.connect(websocket, user_id)
+    connection = await manager.connect(websocket, user_id)
+    await presence.connected(user_id)
     
     try:
         while True:
-            data = await websocket.receive_json()
+            data = await connection.receive()
+            frame_type = data.get("type")
+            ws_frames_received.inc(frame_type if frame_type in WS_FRAME_TYPES else "other")
+            presence.touch(user_id)
+            
+            # Over-limit frames are answered with an error frame and skipped
+            retry_after = connection.frames.take()
+            if retry_after:
+                rate_limited.inc("ws_connection")
+            elif frame_type in ws_frame_limiters:
+                retry_after = ws_frame_limiters[frame_type].take(user_id)
+            if retry_after:
+                connection.enqueue({
+                    "type": "error", "code": "rate_limited", "frame_type": frame_type,
+                    "retry_after": round(retry_after, 2)
+                })
+                continue
+            holds_slot = frame_type in WS_EXPENSIVE_FRAMES
+            if holds_slot and not admission.try_acquire():
+                connection.enqueue({"type": "error", "code": "busy", "frame_type": frame_type, "retry_after": 1})
+                continue
+            
+            try:
+                if data.get("type") == "ping":
+                    connection.enqueue({"type": "pong"})
             
-            if data.get("type") == "message":
-                conv_id = data.get("conversation_id")
-                conv = await db.conversations.find_one({"id": conv_id}, {"_id": 0})
+                elif data.get("type") == "sync":
+                    # Sent right after (re)connecting: this socket is already
+                    # registered, so anything committed after the query arrives live
+                    since = data.get("since") or {}
+                    if isinstance(since, dict):
+                        result = await sync_conversations(user_id, since)
+                        connection.enqueue({"type": "sync", **result.model_dump()})
+            
+                elif data.get("type") == "message":
+                    conv_id = data.get("conversation_id")
+                    conv = await get_conversation_cached(conv_id)
                 
-                if conv and user_id in conv["participants"]:
-                    user = await db.users.find_one({"id": user_id}, {"_id": 0})
-                    
-                    reply_data = None
-                    if data.get("reply_to"):
-                        reply_msg = await db.messages.find_one({"id": data["reply_to"]}, {"_id": 0})
-                        if reply_msg:
-                            reply_data = {
-                                "id": reply_msg["id"],
-                                "content": reply_msg.get("content"),
-                                "sender_name": reply_msg["sender_name"],
-                                "type": reply_msg["type"]
-                            }
-                    
-                    msg_id = str(uuid.uuid4())
-                    timestamp = datetime.now(timezone.utc).isoformat()
+                    if conv and user_id in conv["participants"]:
+                        user = await get_user_cached(user_id)
                     
-                    msg_doc = {
-                        "id": msg_id,
-                        "conversation_id": conv_id,
-                        "sender_id": user_id,
-                        "sender_name": user["display_name"],
-                        "content": data.get("content"),
-                        "type": data.get("msg_type", "text"),
-                        "file_url": data.get("file_url"),
-                        "reply_to": reply_data,
-                        "timestamp": timestamp,
-                        "status": "sent"
-                    }
+                        reply_data = await get_reply_data(data.get("reply_to"), conv_id)
                     
-                    await db.messages.insert_one(msg_doc)
+                        msg_id = str(uuid.uuid4())
+                        timestamp = datetime.now(timezone.utc).isoformat()
                     
-                    # Update conversation
-                    other_user_id = [p for p in conv["participants"] if p != user_id][0]
-                    await db.conversations.update_one(
-                        {"id": conv_id},
-                        {
-                            "$set": {"last_message_id": msg_id},
-                            "$inc": {f"unread_count.{other_user_id}": 1}
+                        msg_doc = {
+                            "id": msg_id,
+                            "conversation_id": conv_id,
+                            "sender_id": user_id,
+                            "sender_name": user["display_name"],
+                            "content": data.get("content"),
+                            "type": data.get("msg_type", "text"),
+                            # File messages only come from the upload routes: a URL
+                            # here would grant access to media through this conversation
+                            "file_url": None,
+                            "reply_to": reply_data,
+                            "timestamp": timestamp,
+                            "status": "sent"
                         }
-                    )
                     
-                    # Send to both users
-                    response = {"type": "new_message", "message": msg_doc}
-                    await manager.send_personal_message(response, user_id)
-                    await manager.send_personal_message(response, other_user_id)
+                        await record_message(conv, msg_doc)
+                    
+                        # Every member, the sender's other tabs included
+                        response = {"type": "new_message", "message": msg_doc}
+                        await manager.publish(response, conv["participants"])
             
-            elif data.get("type") == "typing":
-                conv_id = data.get("conversation_id")
-                conv = await db.conversations.find_one({"id": conv_id}, {"_id": 0})
-                if conv:
-                    other_user_id = [p for p in conv["participants"] if p != user_id][0]
-                    await manager.send_personal_message(
-                        {"type": "typing", "user_id": user_id, "conversation_id": conv_id},
-                        other_user_id
-                    )
+                elif data.get("type") == "typing":
+                    conv_id = data.get("conversation_id")
+                    conv = await get_conversation_cached(conv_id)
+                    if conv and user_id in conv["participants"]:
+                        await manager.publish(
+                            {"type": "typing", "user_id": user_id, "conversation_id": conv_id},
+                            [p for p in conv["participants"] if p != user_id]
+                        )
             
-            elif data.get("type") == "read":
-                conv_id = data.get("conversation_id")
-                await db.messages.update_many(
-                    {"conversation_id": conv_id, "sender_id": {"$ne": user_id}},
-                    {"$set": {"status": "read"}}
-                )
-                conv = await db.conversations.find_one({"id": conv_id}, {"_id": 0})
-                if conv:
-                    other_user_id = [p for p in conv["participants"] if p != user_id][0]
-                    await manager.send_personal_message(
-                        {"type": "messages_read", "conversation_id": conv_id},
-                        other_user_id
-                    )
+                elif data.get("type") == "read":
+                    conv_id = data.get("conversation_id")
+                    conv = await get_conversation_cached(conv_id)
+                    if conv and user_id in conv["participants"]:
+                        updated = await mark_conversation_read(conv_id, user_id)
+                        await manager.publish(
+                            {
+                                "type": "messages_read",
+                                "conversation_id": conv_id,
+                                "user_id": user_id,
+                                "read_upto": (updated or {}).get("read_upto", {}).get(user_id),
+                                "seq": committed_seq(updated) if updated else None
+                            },
+                            [p for p in conv["participants"] if p != user_id]
+                        )
+            finally:
+                if holds_slot:
+                    admission.release()
     
     except WebSocketDisconnect:
-        manager.disconnect(user_id)
-        await db.users.update_one(
-            {"id": user_id},
-            {"$set": {"is_online": False, "last_seen": datetime.now(timezone.utc).isoformat()}}
-        )
+        pass
+    except Exception:
+        logger.exception("Websocket handler for %s failed", user_id)
+    finally:
+        if manager.disconnect(connection):
+            await presence.disconnected(user_id)
 
 # Include the router in the main app
 app.include_router(api_router)
 
-# Mount static files for uploads (after router to avoid path conflicts)
-app.mount("/uploads", StaticFiles(directory=str(UPLOAD_DIR)), name="uploads")
+class MetricsMiddleware:
+    # Plain ASGI middleware (cheaper than BaseHTTPMiddleware); labels by the
+    # matched route template so ids in paths don't explode cardinality
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        status_code = 500
+        
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+        
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            http_request_duration.observe(time.perf_counter() - started, scope["method"], path, status_code)
+
+register_metric(Gauge(
+    "picochat_ws_connections", "Open websocket connections on this worker",
+    lambda: manager.stats()["connections"]
+))
+register_metric(Gauge(
+    "picochat_ws_users", "Users with at least one websocket on this worker",
+    lambda: manager.stats()["users"]
+))
+register_metric(Gauge(
+    "picochat_ws_queued_events", "Events waiting in websocket send queues",
+    lambda: manager.stats()["queued_events"]
+))
+register_metric(Gauge(
+    "picochat_cache_hits", "Cache hits by cache",
+    lambda: {("user",): user_cache.hits, ("conversation",): conversation_cache.hits},
+    ("cache",)
+))
+register_metric(Gauge(
+    "picochat_cache_misses", "Cache misses by cache",
+    lambda: {("user",): user_cache.misses, ("conversation",): conversation_cache.misses},
+    ("cache",)
+))
+register_metric(Gauge(
+    "picochat_password_hash_in_flight", "bcrypt calls running or queued",
+    lambda: password_hasher.in_flight
+))
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False, dependencies=[Depends(require_internal)])
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+app.add_middleware(MetricsMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -593,6 +3594,270 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ===================== STARTUP / MIGRATIONS =====================
+
+INDEXES = {
+    "users": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("username", ASCENDING)], unique=True, name="username_unique"),
+        IndexModel([("username_key", ASCENDING), ("id", ASCENDING)], name="directory_order"),
+        IndexModel(
+            [("directory_terms", ASCENDING), ("username_key", ASCENDING), ("id", ASCENDING)],
+            name="directory_terms"
+        ),
+    ],
+    "conversations": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("participants", ASCENDING), ("last_activity", DESCENDING)], name="participants_last_activity"),
+    ],
+    "upload_sessions": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at"),
+    ],
+    "media": [
+        IndexModel([("hash", ASCENDING)], unique=True, name="hash_unique"),
+    ],
+    "message_buckets": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("conversation_id", ASCENDING), ("start_ts", ASCENDING)], name="conversation_timeline"),
+        IndexModel([("conversation_id", ASCENDING), ("end_seq", ASCENDING)], name="conversation_seq"),
+        IndexModel([("search_terms", ASCENDING), ("end_ts", DESCENDING)], name="search_terms"),
+        IndexModel([("conversation_id", ASCENDING), ("file_urls", ASCENDING)], name="conversation_files"),
+    ],
+    "messages": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel(
+            [("conversation_id", ASCENDING), ("timestamp", ASCENDING), ("id", ASCENDING)],
+            name="conversation_timeline"
+        ),
+        # Equality on a term plus $in over conversations merges the per-conversation
+        # runs already in (timestamp, id) order, so search needs no blocking sort
+        IndexModel(
+            [("search_terms", ASCENDING), ("conversation_id", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)],
+            name="search_terms_timeline"
+        ),
+        IndexModel(
+            [("conversation_id", ASCENDING), ("seq", ASCENDING)],
+            unique=True, name="conversation_seq", partialFilterExpression={"seq": {"$type": "number"}}
+        ),
+        # Media access checks; partial so text messages stay out of them
+        IndexModel(
+            [("conversation_id", ASCENDING), ("file_url", ASCENDING)],
+            name="conversation_files", partialFilterExpression={"file_url": {"$type": "string"}}
+        ),
+        IndexModel(
+            [("conversation_id", ASCENDING), ("preview.thumbnail_url", ASCENDING)],
+            name="conversation_thumbnails", partialFilterExpression={"preview.thumbnail_url": {"$type": "string"}}
+        ),
+    ],
+}
+
+async def migrate_conversation_activity():
+    # Conversations created before last_activity existed sort by creation time
+    async for conv in db.conversations.find({"last_activity": {"$exists": False}}, {"_id": 0, "id": 1, "created_at": 1}):
+        await db.conversations.update_one(
+            {"id": conv["id"]},
+            {"$set": {"last_activity": conv.get("created_at")}}
+        )
+
+async def migrate_message_search_terms():
+    # Index terms for messages stored before search existed
+    operations = []
+    async for msg in db.messages.find({"search_terms": {"$exists": False}}, {"_id": 1, "content": 1}):
+        operations.append(UpdateOne({"_id": msg["_id"]}, {"$set": {"search_terms": search_terms(msg.get("content"))}}))
+        if len(operations) >= 1000:
+            await db.messages.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        await db.messages.bulk_write(operations, ordered=False)
+
+async def migrate_media_urls():
+    # Files used to be served from the unauthenticated /uploads mount
+    def scoped(conversation_id, url):
+        if url and url.startswith("/uploads/"):
+            return media_url(conversation_id, url[len("/uploads/"):])
+        return url
+    
+    operations = []
+    query = {"$or": [{"file_url": {"$regex": "^/uploads/"}}, {"preview.thumbnail_url": {"$regex": "^/uploads/"}}]}
+    async for msg in db.messages.find(query, {"_id": 1, "conversation_id": 1, "file_url": 1, "preview": 1}):
+        update = {"file_url": scoped(msg["conversation_id"], msg.get("file_url"))}
+        if msg.get("preview"):
+            update["preview.thumbnail_url"] = scoped(msg["conversation_id"], msg["preview"].get("thumbnail_url"))
+        operations.append(UpdateOne({"_id": msg["_id"]}, {"$set": update}))
+        if len(operations) >= 1000:
+            await db.messages.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        await db.messages.bulk_write(operations, ordered=False)
+    
+    async for conv in db.conversations.find({"last_message.file_url": {"$regex": "^/uploads/"}}, {"_id": 0, "id": 1, "last_message": 1}):
+        update = {"last_message.file_url": scoped(conv["id"], conv["last_message"]["file_url"])}
+        if conv["last_message"].get("preview"):
+            update["last_message.preview.thumbnail_url"] = scoped(conv["id"], conv["last_message"]["preview"].get("thumbnail_url"))
+        await db.conversations.update_one({"id": conv["id"]}, {"$set": update})
+    
+    async for media in db.media.find({"preview.thumbnail_url": {"$exists": True}}, {"_id": 0, "hash": 1, "preview": 1}):
+        await db.media.update_one(
+            {"hash": media["hash"]},
+            {
+                "$set": {"preview.thumbnail_path": media["preview"]["thumbnail_url"][len("/uploads/"):]},
+                "$unset": {"preview.thumbnail_url": ""}
+            }
+        )
+
+async def migrate_message_sequences():
+    # Number existing history in timeline order so syncs can resume from it
+    async for conv in db.conversations.find({"seq": {"$exists": False}}, {"_id": 0, "id": 1}):
+        seq = 0
+        operations = []
+        cursor = db.messages.find({"conversation_id": conv["id"]}, {"_id": 1}).sort([("timestamp", 1), ("id", 1)])
+        async for msg in cursor:
+            seq += 1
+            operations.append(UpdateOne({"_id": msg["_id"]}, {"$set": {"seq": seq}}))
+            if len(operations) >= 1000:
+                await db.messages.bulk_write(operations, ordered=False)
+                operations = []
+        if operations:
+            await db.messages.bulk_write(operations, ordered=False)
+        await db.conversations.update_one(
+            {"id": conv["id"], "seq": {"$exists": False}},
+            {"$set": {"seq": seq, **({"last_message.seq": seq} if seq else {})}}
+        )
+
+async def migrate_user_directory():
+    operations = []
+    async for user in db.users.find({"username_key": {"$exists": False}}, {"_id": 1, "username": 1, "display_name": 1}):
+        fields = directory_fields(user["username"], user.get("display_name") or "")
+        operations.append(UpdateOne({"_id": user["_id"]}, {"$set": fields}))
+        if len(operations) >= 1000:
+            await db.users.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        await db.users.bulk_write(operations, ordered=False)
+
+async def migrate_search_index():
+    # Superseded by search_terms_timeline, which also covers the sort
+    if "search_terms" in await db.messages.index_information():
+        await db.messages.drop_index("search_terms")
+
+# One worker applies migrations under a lease in db.meta; the others wait
+# for the schema version to catch up before they start serving. A heartbeat
+# renews the lease while a step runs, so the TTL only decides how soon a
+# dead migrator's lease can be taken over.
+MIGRATION_LEASE_SECONDS = float(os.environ.get('MIGRATION_LEASE_SECONDS', '60'))
+MIGRATION_POLL_SECONDS = 1.0
+
+# Applied in order; the position in this list is the schema version
+MIGRATIONS = [
+    migrate_conversation_activity,
+    migrate_message_search_terms,
+    migrate_media_urls,
+    migrate_message_sequences,
+    migrate_user_directory,
+    migrate_search_index,
+]
+
+async def ensure_indexes(unique: bool):
+    # Plain indexes are built before the migrations (which query through
+    # them), unique ones after, once the migrations have fixed the data
+    for collection, indexes in INDEXES.items():
+        models = [index for index in indexes if bool(index.document.get("unique")) == unique]
+        if not models:
+            continue
+        if not unique:
+            await db[collection].create_indexes(models)
+            continue
+        for index in models:
+            try:
+                await db[collection].create_indexes([index])
+            except OperationFailure:
+                # Serving on without the constraint beats refusing to start
+                logger.exception("Unique index %s.%s could not be built", collection, index.document["name"])
+
+async def schema_version() -> int:
+    meta = await db.meta.find_one({"_id": "schema"}) or {}
+    return meta.get("version", 0)
+
+async def acquire_migration_lease() -> bool:
+    now = datetime.now(timezone.utc)
+    try:
+        await db.meta.find_one_and_update(
+            {"_id": "migrations", "locked_until": {"$lt": now.isoformat()}},
+            {"$set": {
+                "owner": WORKER_ID,
+                "locked_until": (now + timedelta(seconds=MIGRATION_LEASE_SECONDS)).isoformat()
+            }},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # Another worker is migrating
+        return False
+    return True
+
+async def renew_migration_lease():
+    locked_until = datetime.now(timezone.utc) + timedelta(seconds=MIGRATION_LEASE_SECONDS)
+    await db.meta.update_one(
+        {"_id": "migrations", "owner": WORKER_ID},
+        {"$set": {"locked_until": locked_until.isoformat()}}
+    )
+
+async def hold_migration_lease():
+    while True:
+        await asyncio.sleep(MIGRATION_LEASE_SECONDS / 3)
+        try:
+            await renew_migration_lease()
+        except Exception:
+            logger.exception("Renewing the migration lease failed")
+
+async def release_migration_lease():
+    await db.meta.update_one({"_id": "migrations", "owner": WORKER_ID}, {"$set": {"locked_until": ""}})
+
+async def run_migrations():
+    waiting = False
+    while await schema_version() < len(MIGRATIONS):
+        if not await acquire_migration_lease():
+            if not waiting:
+                logger.info("Waiting for another worker to finish migrations")
+                waiting = True
+            await asyncio.sleep(MIGRATION_POLL_SECONDS)
+            continue
+        heartbeat = asyncio.create_task(hold_migration_lease())
+        try:
+            # Re-read under the lease: the previous holder may have finished
+            version = await schema_version()
+            for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                logger.info("Applying migration %d: %s", number, migration.__name__)
+                await migration()
+                await db.meta.update_one(
+                    {"_id": "schema"},
+                    {"$set": {"version": number, "updated_at": datetime.now(timezone.utc).isoformat()}},
+                    upsert=True
+                )
+        finally:
+            heartbeat.cancel()
+            await release_migration_lease()
+
+@app.on_event("startup")
+async def startup_db_client():
+    await ensure_indexes(unique=False)
+    await run_migrations()
+    await ensure_indexes(unique=True)
+    await manager.broker.start(manager.deliver_local)
+    loop_monitor.start()
+    presence.start()
+    message_archiver.start()
+    upload_cleaner.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    loop_monitor.stop()
+    message_archiver.stop()
+    upload_cleaner.stop()
+    await message_batcher.drain()
+    if sequence_commits:
+        await asyncio.gather(*sequence_commits, return_exceptions=True)
+    await presence.stop()
+    preview_generator.shutdown()
+    await manager.broker.stop()
     client.close()
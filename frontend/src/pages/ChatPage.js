@@ -1,4 +1,4 @@
-import { useState, useEffect, useRef, useCallback } from 'react';
+import { useState, useEffect, useLayoutEffect, useRef, useCallback } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { motion, AnimatePresence } from 'framer-motion';
 import axios from 'axios';
@@ -26,7 +26,8 @@ import {
     Play,
     Pause,
     ArrowRight,
-    Menu
+    Menu,
+    Search
 } from 'lucide-react';
 import { toast } from 'sonner';
 
@@ -39,9 +40,14 @@ export default function ChatPage() {
     const navigate = useNavigate();
     
     const [users, setUsers] = useState([]);
+    const [userQuery, setUserQuery] = useState('');
+    const [usersCursor, setUsersCursor] = useState(null);
+    const [loadingMoreUsers, setLoadingMoreUsers] = useState(false);
     const [selectedUser, setSelectedUser] = useState(null);
     const [conversation, setConversation] = useState(null);
     const [messages, setMessages] = useState([]);
+    const [olderCursor, setOlderCursor] = useState(null);
+    const [loadingOlder, setLoadingOlder] = useState(false);
     const [newMessage, setNewMessage] = useState('');
     const [replyTo, setReplyTo] = useState(null);
     const [showEmoji, setShowEmoji] = useState(false);
@@ -53,6 +59,10 @@ export default function ChatPage() {
     const [isMobile, setIsMobile] = useState(window.innerWidth < 768);
     
     const messagesEndRef = useRef(null);
+    const messagesContainerRef = useRef(null);
+    const scrollAnchorRef = useRef(null);
+    const olderRequestRef = useRef(null);
+    const usersRequestRef = useRef(0);
     const fileInputRef = useRef(null);
     const textareaRef = useRef(null);
     const mediaRecorderRef = useRef(null);
@@ -83,18 +93,49 @@ export default function ChatPage() {
         }
     }, []);
 
-    // Fetch users
+    // Fetch users - جستجو سمت سرور با q و کمی تأخیر بین تایپ‌ها
     useEffect(() => {
+        const requestId = ++usersRequestRef.current;
         const fetchUsers = async () => {
             try {
-                const response = await axios.get(`${API}/api/users`);
-                setUsers(response.data);
+                const response = await axios.get(`${API}/api/users`, {
+                    params: { q: userQuery.trim() || undefined }
+                });
+                if (requestId !== usersRequestRef.current) return;
+                setUsers(response.data.users);
+                setUsersCursor(response.data.next_cursor);
             } catch (error) {
+                if (requestId !== usersRequestRef.current) return;
+                setUsers([]);
+                setUsersCursor(null);
                 console.error('Error fetching users:', error);
             }
         };
-        fetchUsers();
-    }, []);
+        const timeout = setTimeout(fetchUsers, userQuery ? 300 : 0);
+        return () => clearTimeout(timeout);
+    }, [userQuery]);
+
+    // صفحه بعدی لیست کاربران با next_cursor
+    const loadMoreUsers = async () => {
+        if (!usersCursor || loadingMoreUsers) return;
+        const requestId = usersRequestRef.current;
+        setLoadingMoreUsers(true);
+        try {
+            const response = await axios.get(`${API}/api/users`, {
+                params: { q: userQuery.trim() || undefined, cursor: usersCursor }
+            });
+            if (requestId !== usersRequestRef.current) return;
+            setUsers(prev => {
+                const currentIds = new Set(prev.map(u => u.id));
+                return [...prev, ...response.data.users.filter(u => !currentIds.has(u.id))];
+            });
+            setUsersCursor(response.data.next_cursor);
+        } catch (error) {
+            toast.error('خطا در بارگذاری کاربران');
+        } finally {
+            setLoadingMoreUsers(false);
+        }
+    };
 
     // WebSocket connection
     useEffect(() => {
@@ -154,7 +195,7 @@ export default function ChatPage() {
                     // ID های پیام‌های فعلی (بدون temp)
                     const currentIds = new Set(prev.filter(m => !m.id.startsWith('temp-')).map(m => m.id));
                     // پیام‌های جدیدی که قبلاً نداشتیم
-                    const newMessages = response.data.filter(m => !currentIds.has(m.id));
+                    const newMessages = response.data.messages.filter(m => !currentIds.has(m.id));
                     
                     // اگر پیام جدیدی نیست، چیزی تغییر نکنه
                     if (newMessages.length === 0) {
@@ -183,11 +224,15 @@ export default function ChatPage() {
     useEffect(() => {
         const pollUsers = async () => {
             try {
-                const response = await axios.get(`${API}/api/users`);
-                setUsers(response.data);
+                const response = await axios.get(`${API}/api/users`, {
+                    params: { q: userQuery.trim() || undefined }
+                });
+                // فقط وضعیت کاربرانی که در لیست هستند به‌روز می‌شود تا صفحه‌های بعدی از دست نروند
+                const fresh = new Map(response.data.users.map(u => [u.id, u]));
+                setUsers(prev => prev.map(u => fresh.get(u.id) ?? u));
                 // آپدیت وضعیت کاربر انتخاب شده
                 if (selectedUser) {
-                    const updated = response.data.find(u => u.id === selectedUser.id);
+                    const updated = response.data.users.find(u => u.id === selectedUser.id);
                     if (updated) {
                         setSelectedUser(updated);
                     }
@@ -199,7 +244,52 @@ export default function ChatPage() {
 
         const interval = setInterval(pollUsers, 5000);
         return () => clearInterval(interval);
-    }, [selectedUser]);
+    }, [selectedUser, userQuery]);
+
+    // بعد از اضافه شدن پیام‌های قدیمی‌تر به بالا، موقعیت اسکرول حفظ می‌شود
+    useLayoutEffect(() => {
+        const container = messagesContainerRef.current;
+        if (container && scrollAnchorRef.current !== null) {
+            container.scrollTop += container.scrollHeight - scrollAnchorRef.current;
+            scrollAnchorRef.current = null;
+        }
+    }, [messages]);
+
+    // بارگذاری صفحه قبلی تاریخچه با next_cursor
+    const loadOlderMessages = async () => {
+        if (!conversation || !olderCursor || olderRequestRef.current) return;
+        const convId = conversation.id;
+        olderRequestRef.current = convId;
+        setLoadingOlder(true);
+        try {
+            const response = await axios.get(`${API}/api/messages/${convId}`, {
+                params: { before: olderCursor }
+            });
+            // اگر در این فاصله گفتگو عوض شده باشد، پاسخ نادیده گرفته می‌شود
+            if (olderRequestRef.current !== convId) return;
+            scrollAnchorRef.current = messagesContainerRef.current?.scrollHeight ?? null;
+            setMessages(prev => {
+                const currentIds = new Set(prev.map(m => m.id));
+                return [...response.data.messages.filter(m => !currentIds.has(m.id)), ...prev];
+            });
+            setOlderCursor(response.data.next_cursor);
+        } catch (error) {
+            if (olderRequestRef.current === convId) {
+                toast.error('خطا در بارگذاری پیام‌های قدیمی‌تر');
+            }
+        } finally {
+            if (olderRequestRef.current === convId) {
+                olderRequestRef.current = null;
+                setLoadingOlder(false);
+            }
+        }
+    };
+
+    const handleMessagesScroll = (event) => {
+        if (event.currentTarget.scrollTop < 80) {
+            loadOlderMessages();
+        }
+    };
 
     // اسکرول به آخرین پیام
     const scrollToBottom = () => {
@@ -212,12 +302,16 @@ export default function ChatPage() {
     const selectUser = async (selectedUserData) => {
         setSelectedUser(selectedUserData);
         if (isMobile) setShowSidebar(false);
+        olderRequestRef.current = null;
+        setLoadingOlder(false);
+        setOlderCursor(null);
         try {
             const convResponse = await axios.post(`${API}/api/conversations/${selectedUserData.id}`);
             setConversation(convResponse.data);
             
             const messagesResponse = await axios.get(`${API}/api/messages/${convResponse.data.id}`);
-            setMessages(messagesResponse.data);
+            setMessages(messagesResponse.data.messages);
+            setOlderCursor(messagesResponse.data.next_cursor);
             
             // اسکرول به آخرین پیام بعد از لود شدن
             setTimeout(() => {
@@ -463,13 +557,28 @@ export default function ChatPage() {
                             </div>
                         </div>
 
+                        {/* Search */}
+                        <div className="px-3 pt-3">
+                            <div className="relative">
+                                <Search className="absolute right-3 top-1/2 -translate-y-1/2 h-4 w-4 text-muted-foreground" />
+                                <Input
+                                    value={userQuery}
+                                    onChange={(e) => setUserQuery(e.target.value)}
+                                    placeholder="جستجوی کاربران..."
+                                    maxLength={100}
+                                    className="pr-9"
+                                    data-testid="user-search-input"
+                                />
+                            </div>
+                        </div>
+
                         {/* User List */}
                         <ScrollArea className="flex-1">
                             <div className="p-3">
                                 <p className="text-xs font-medium text-muted-foreground mb-3 px-2">کاربران</p>
                                 {users.length === 0 ? (
                                     <div className="text-center py-8 text-muted-foreground text-sm">
-                                        هنوز کاربر دیگری ثبت‌نام نکرده
+                                        {userQuery.trim() ? 'کاربری یافت نشد' : 'هنوز کاربر دیگری ثبت‌نام نکرده'}
                                     </div>
                                 ) : (
                                     users.map((u) => (
@@ -501,6 +610,18 @@ export default function ChatPage() {
                                         </motion.button>
                                     ))
                                 )}
+                                {usersCursor && (
+                                    <Button
+                                        variant="ghost"
+                                        size="sm"
+                                        onClick={loadMoreUsers}
+                                        disabled={loadingMoreUsers}
+                                        className="w-full mt-2 text-xs text-muted-foreground"
+                                        data-testid="load-more-users-btn"
+                                    >
+                                        {loadingMoreUsers ? 'در حال بارگذاری...' : 'کاربران بیشتر'}
+                                    </Button>
+                                )}
                             </div>
                         </ScrollArea>
                     </motion.div>
@@ -560,10 +681,26 @@ export default function ChatPage() {
 
                         {/* Messages - Scrollable با padding برای هدر و input */}
                         <div 
+                            ref={messagesContainerRef}
+                            onScroll={handleMessagesScroll}
                             className="absolute inset-0 overflow-y-auto p-3 md:p-4 overscroll-contain"
                             style={{ paddingTop: '70px', paddingBottom: '80px' }}
                         >
                             <div className="space-y-3 md:space-y-4 max-w-3xl mx-auto">
+                                {olderCursor && (
+                                    <div className="text-center">
+                                        <Button
+                                            variant="ghost"
+                                            size="sm"
+                                            onClick={loadOlderMessages}
+                                            disabled={loadingOlder}
+                                            className="text-xs text-muted-foreground"
+                                            data-testid="load-older-btn"
+                                        >
+                                            {loadingOlder ? 'در حال بارگذاری...' : 'پیام‌های قدیمی‌تر'}
+                                        </Button>
+                                    </div>
+                                )}
                                 {messages.map((msg) => (
                                     <MessageBubble
                                         key={msg.id}
@@ -760,11 +897,44 @@ export default function ChatPage() {
     );
 }
 
+// Media tags can't send the Authorization header, so they load files through
+// short-lived URLs signed for that file. Shared by every bubble showing it.
+const mediaUrls = new Map();
+
+function useMediaUrl(fileUrl) {
+    const [url, setUrl] = useState(null);
+
+    useEffect(() => {
+        if (!fileUrl) return;
+        const cached = mediaUrls.get(fileUrl);
+        if (cached && cached.expiresAt - Date.now() > 60000) {
+            setUrl(cached.url);
+            return;
+        }
+        let cancelled = false;
+        axios.post(`${API}/api/media/token`, { url: fileUrl })
+            .then((response) => {
+                const entry = {
+                    url: `${API}${response.data.url}`,
+                    expiresAt: Date.parse(response.data.expires_at)
+                };
+                mediaUrls.set(fileUrl, entry);
+                if (!cancelled) setUrl(entry.url);
+            })
+            .catch((error) => console.error('Failed to sign media URL:', error));
+        return () => {
+            cancelled = true;
+        };
+    }, [fileUrl]);
+
+    return url;
+}
+
 // Message Bubble Component
 function MessageBubble({ message, isMe, onReply, isMobile }) {
     const [isPlaying, setIsPlaying] = useState(false);
     const audioRef = useRef(null);
-    const API_BASE = process.env.REACT_APP_BACKEND_URL;
+    const fileUrl = useMediaUrl(message.file_url);
 
     const toggleAudio = () => {
         if (audioRef.current) {
@@ -782,16 +952,16 @@ function MessageBubble({ message, isMe, onReply, isMobile }) {
             case 'image':
                 return (
                     <img
-                        src={`${API_BASE}${message.file_url}`}
+                        src={fileUrl}
                         alt="تصویر"
                         className="max-w-[200px] md:max-w-[300px] rounded-xl cursor-pointer hover:opacity-90 transition-opacity"
-                        onClick={() => window.open(`${API_BASE}${message.file_url}`, '_blank')}
+                        onClick={() => fileUrl && window.open(fileUrl, '_blank', 'noopener')}
                     />
                 );
             case 'video':
                 return (
                     <video
-                        src={`${API_BASE}${message.file_url}`}
+                        src={fileUrl}
                         controls
                         className="max-w-[200px] md:max-w-[300px] rounded-xl"
                     />
@@ -818,7 +988,7 @@ function MessageBubble({ message, isMe, onReply, isMobile }) {
                         </div>
                         <audio
                             ref={audioRef}
-                            src={`${API_BASE}${message.file_url}`}
+                            src={fileUrl}
                             onEnded={() => setIsPlaying(false)}
                         />
                     </div>
@@ -486,6 +486,7 @@ server {
         proxy_set_header Host \$host;
     }
     
+    # Old /uploads links: redirected or answered with 410 by the backend
     location /uploads {
         proxy_pass http://127.0.0.1:$BACKEND_PORT;
     }
@@ -542,6 +543,7 @@ server {
         proxy_set_header Host \$host;
     }
     
+    # Old /uploads links: redirected or answered with 410 by the backend
     location /uploads {
         proxy_pass http://127.0.0.1:$BACKEND_PORT;
     }